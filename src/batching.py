@@ -0,0 +1,63 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class BatchController:
+    """
+    Chooses how many buffered spectra the reducer fits at once and when the
+    timer runs again.
+
+    The fit time per spectrum is tracked as a moving average, the batch size is
+    the number of spectra which fit in `target_latency`, bounded by `min_batch`
+    and `max_batch`. Fewer than `min_batch` spectra are only fitted once the
+    oldest waited `max_wait`. Larger buffers are split into several batches and
+    the timer returns immediately to fit the next one.
+    """
+
+    def __init__(self, target_latency=0.5, min_batch=1, max_batch=10000, max_wait=0.5):
+        self.target_latency = target_latency
+        self.min_batch = max(min_batch, 1)
+        self.max_batch = max(max_batch, self.min_batch)
+        self.max_wait = max_wait
+        self.cost = None
+        self.smoothing = 0.3
+
+    def record(self, spectra, seconds):
+        if spectra == 0:
+            return
+        cost = seconds / spectra
+        if self.cost is None:
+            self.cost = cost
+        else:
+            self.cost += self.smoothing * (cost - self.cost)
+
+    def batch_size(self):
+        if self.cost is None or self.cost <= 0:
+            return self.max_batch
+        size = int(self.target_latency / self.cost)
+        return int(np.clip(size, self.min_batch, self.max_batch))
+
+    def take(self, buffered, age):
+        """
+        :param buffered: number of spectra in the buffer
+        :param age: seconds since the oldest buffered spectrum arrived
+        :return: number of spectra to fit now
+        """
+        if buffered == 0:
+            return 0
+        if buffered < self.min_batch and age < self.max_wait:
+            return 0
+        return min(buffered, self.batch_size())
+
+    def interval(self, buffered, age):
+        """
+        :return: seconds until the timer should run again
+        """
+        if buffered >= self.min_batch:
+            return 0
+        if buffered > 0:
+            return max(self.max_wait - age, 0)
+        return self.max_wait
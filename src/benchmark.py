@@ -0,0 +1,358 @@
+"""
+Throughput benchmarks of the hot paths of the worker and the reducer.
+
+Runs offline on the files in data/ and on synthetic frames and writes the
+results as json, e.g.
+
+    python -m src.benchmark --output benchmark.json
+    python -m src.benchmark --baseline benchmark.json --only worker fit
+
+With a baseline, the exit code is 1 if a throughput dropped by more than the
+tolerance.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cbor2
+import h5py
+import numpy as np
+from bitshuffle import compress_lz4
+from dranspose.data.stream1 import Stream1Data, Stream1End, Stream1Start
+from dranspose.event import EventData, InternalWorkerMessage, StreamData
+from dranspose.replay import get_internals, get_parameters
+
+from src.bslz4 import Decoder
+from src.fit import PreparedFit
+from src.reducer import FluorescenceReducer
+from src.worker import FluorescenceWorker
+from src.xrf_source import XRFSource
+
+logger = logging.getLogger(__name__)
+
+FIT_CONFIG = "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg"
+SPECTRA = "data/scan_000008_xspress3.hdf5"
+RECORDINGS = ["data/xspress_ingest.pkls", "data/contrast_ingest.pkls"]
+
+# minimum seconds a measurement is repeated for
+MIN_TIME = 1.0
+
+
+def parameters(extra=()):
+    """
+    :param extra: (name, bytes) of parameters besides params.json
+    :return: parsed parameters of the worker and the reducer
+    """
+    with open("params.json") as f:
+        plist = [{"name": p["name"], "data": p["data"].encode()} for p in json.load(f)]
+    plist += [{"name": name, "data": data} for name, data in extra]
+    with tempfile.NamedTemporaryFile(suffix=".cbor") as fp:
+        cbor2.dump(plist, fp)
+        fp.flush()
+        return get_parameters(fp.name, FluorescenceWorker, FluorescenceReducer)
+
+
+def repeat(fn, items=1, min_time=MIN_TIME):
+    """
+    calls fn until min_time passed
+
+    :param items: number of items fn processes per call
+    :return: dict with the items, seconds and items per second
+    """
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    return {
+        "items": calls * items,
+        "seconds": elapsed,
+        "per_second": calls * items / elapsed,
+    }
+
+
+def merge(generators):
+    """
+    :return: events of the generators of a source, which advance in lockstep
+    """
+    return [EventData.from_internals(list(msgs)) for msgs in zip(*generators)]
+
+
+def stins_frames(stream, frames):
+    """
+    :return: events of a stins stream with the bslz4 compressed frames
+    """
+    msg_number = itertools.count(0)
+    start = Stream1Start(htype="header", filename="", msg_number=next(msg_number))
+    msgs = [
+        InternalWorkerMessage(
+            event_number=0,
+            streams={stream: StreamData(typ="STINS", frames=[start.model_dump_json()])},
+        )
+    ]
+    for frameno, image in enumerate(frames):
+        header = Stream1Data(
+            htype="image",
+            msg_number=next(msg_number),
+            frame=frameno,
+            shape=image.shape,
+            compression="bslz4",
+            type=str(image.dtype),
+        ).model_dump_json()
+        msgs.append(
+            InternalWorkerMessage(
+                event_number=frameno + 1,
+                streams={
+                    stream: StreamData(
+                        typ="STINS", frames=[header, compress_lz4(image).tobytes()]
+                    )
+                },
+            )
+        )
+    end = Stream1End(htype="series_end", msg_number=next(msg_number))
+    msgs.append(
+        InternalWorkerMessage(
+            event_number=len(frames),
+            streams={stream: StreamData(typ="STINS", frames=[end.model_dump_json()])},
+        )
+    )
+    return [EventData.from_internals([msg]) for msg in msgs]
+
+
+def poisson_frames(shape, count, lam=2.0, seed=0):
+    """
+    :return: count int32 frames of photon counts, compressible like real data
+    """
+    rng = np.random.default_rng(seed)
+    return [rng.poisson(lam, shape).astype(np.int32) for _ in range(count)]
+
+
+def bench_worker(events, extra=(), min_time=MIN_TIME):
+    """
+    :param events: list of EventData, cycled through
+    :return: events per second of FluorescenceWorker.process_event
+    """
+    params = parameters(extra)
+    worker = FluorescenceWorker(parameters=params)
+    cycle = itertools.cycle(events)
+    result = repeat(
+        lambda: worker.process_event(next(cycle), params), min_time=min_time
+    )
+    worker.finish(params)
+    return result
+
+
+def worker_cases(frames):
+    """
+    :return: dict of case name to a function returning the events and the extra
+        parameters
+    """
+    with open(FIT_CONFIG, "rb") as f:
+        config = f.read()
+
+    def xspress():
+        source = XRFSource()
+        source.slice = slice(None)
+        return merge(source.get_source_generators())
+
+    return {
+        "xspress3": lambda: (xspress(), ()),
+        "xspress3_fit": lambda: (
+            xspress(),
+            (("mca_config", config), ("worker_fit", b"True")),
+        ),
+        "recording": lambda: (
+            merge([get_internals(name) for name in RECORDINGS]),
+            (),
+        ),
+        "eiger": lambda: (
+            stins_frames("eiger-1m", poisson_frames((1065, 1030), frames)),
+            (("eiger_rois", b'{"center": [400, 600, 400, 600]}'),),
+        ),
+        "pilatus": lambda: (
+            stins_frames("pilatus", poisson_frames((1043, 981), frames)),
+            (),
+        ),
+    }
+
+
+def guarded(name, bench):
+    """
+    :return: the result of bench or the error if it failed
+    """
+    logger.info("running %s benchmark", name)
+    try:
+        return bench()
+    except Exception as e:
+        logger.error("benchmark %s failed: %s", name, e.__repr__())
+        return {"error": e.__repr__()}
+
+
+def bench_fit(batch_sizes, min_time=MIN_TIME):
+    """
+    :return: spectra per second of the reducer fit per batch size
+    """
+    with h5py.File(SPECTRA, "r") as f:
+        spectra = f["entry/instrument/xspress3/data"][:, 3]
+    fit = PreparedFit()
+    fit.setFitConfigurationFile(FIT_CONFIG)
+    fit.prepare(y=spectra[: max(batch_sizes)], weight=0, concentrations=1)
+    results = {}
+    for size in batch_sizes:
+        batches = itertools.cycle(
+            spectra[i : i + size] for i in range(0, len(spectra) - size + 1, size)
+        )
+        results[str(size)] = repeat(
+            lambda: fit.fit(next(batches), refit=1, concentrations=1),
+            size,
+            min_time,
+        )
+    return results
+
+
+def bench_bslz4(threads, min_time=MIN_TIME):
+    """
+    :return: decompressed GB/s of the Decoder per number of threads
+    """
+    image = poisson_frames((2167, 2070), 1)[0]
+    frame = compress_lz4(image).tobytes()
+    results = {}
+    for count in threads:
+        decoder = Decoder(threads=count)
+
+        def decode():
+            decoder.release(decoder.decode(frame, image.shape, image.dtype))
+
+        result = repeat(decode, image.nbytes, min_time)
+        result["gb_per_second"] = result["per_second"] / 1e9
+        decoder.shutdown()
+        results[str(count)] = result
+    return results
+
+
+def bench_azint(frames, min_time=MIN_TIME):
+    """
+    :return: frames per second of the azimuthal integration, without decoding
+    """
+    params = parameters()
+    ai = FluorescenceWorker._integrator(params)
+    images = itertools.cycle(poisson_frames((1043, 981), frames))
+    return repeat(lambda: ai.integrate(next(images)), min_time=min_time)
+
+
+def environment():
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run(
+    only=None,
+    frames=8,
+    batch_sizes=(1, 10, 100, 1000),
+    threads=(1, 2, 4),
+    min_time=MIN_TIME,
+):
+    """
+    runs the selected benchmarks, a benchmark which fails is reported with its
+    error instead of results
+
+    :param only: names of the benchmarks: worker, fit, bslz4 and azint
+    :param min_time: seconds every measurement is repeated for
+    """
+    benchmarks = {
+        "worker": lambda: {
+            name: guarded(name, lambda: bench_worker(*case(), min_time=min_time))
+            for name, case in worker_cases(frames).items()
+        },
+        "fit": lambda: bench_fit(list(batch_sizes), min_time),
+        "bslz4": lambda: bench_bslz4(list(threads), min_time),
+        "azint": lambda: bench_azint(frames, min_time),
+    }
+    results = {"environment": environment(), "min_time": min_time}
+    for name, bench in benchmarks.items():
+        if only and name not in only:
+            continue
+        results[name] = guarded(name, bench)
+    return results
+
+
+def throughputs(results, prefix=""):
+    """
+    :return: flat dict of the path of every measurement to its per_second
+    """
+    flat = {}
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        if "per_second" in value:
+            flat[prefix + key] = value["per_second"]
+        else:
+            flat.update(throughputs(value, f"{prefix}{key}/"))
+    return flat
+
+
+def regressions(results, baseline, tolerance):
+    """
+    :return: list of (path, baseline, current) which dropped by more than tolerance
+    """
+    current = throughputs(results)
+    slower = []
+    for path, before in throughputs(baseline).items():
+        if path in current and current[path] < before * (1 - tolerance):
+            slower.append((path, before, current[path]))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="json file for the results, default stdout")
+    parser.add_argument(
+        "--only", nargs="+", choices=["worker", "fit", "bslz4", "azint"]
+    )
+    parser.add_argument("--frames", type=int, default=8, help="synthetic frames")
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=MIN_TIME,
+        help="seconds every measurement is repeated for",
+    )
+    parser.add_argument("--baseline", help="json results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    results = run(only=args.only, frames=args.frames, min_time=args.min_time)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.tolerance)
+        for path, before, after in slower:
+            logger.error("%s dropped from %g to %g per second", path, before, after)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import ctypes
+import logging
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import zmq
+import bitshuffle.ext
+from bitshuffle import decompress_lz4
+
+logger = logging.getLogger(__name__)
+
+# the dectris stream prepends the uncompressed size (uint64) and the block size
+# in bytes (uint32), both big endian, like the hdf5 filter
+HEADER = 12
+
+_unpack_size = struct.Struct(">I").unpack_from
+
+
+def _load_library():
+    try:
+        lib = ctypes.CDLL(bitshuffle.ext.__file__)
+        decompress = lib.bshuf_decompress_lz4
+        default_block_size = lib.bshuf_default_block_size
+    except (OSError, AttributeError) as e:
+        logger.warning("bitshuffle C library not available: %s", e.__repr__())
+        return None, None
+    decompress.restype = ctypes.c_int64
+    decompress.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_size_t,
+        ctypes.c_size_t,
+    ]
+    default_block_size.restype = ctypes.c_size_t
+    default_block_size.argtypes = [ctypes.c_size_t]
+    return decompress, default_block_size
+
+
+# ctypes releases the GIL during the calls
+_bshuf_decompress_lz4, _bshuf_default_block_size = _load_library()
+
+
+def frame_view(frame):
+    """
+    :return: the bytes of a zmq frame or bytes object as uint8 array without a copy
+    """
+    if isinstance(frame, zmq.Frame):
+        frame = frame.buffer
+    return np.frombuffer(memoryview(frame), dtype=np.uint8)
+
+
+def parse_header(buf, nbytes):
+    """
+    :param buf: compressed frame as uint8 array
+    :param nbytes: size of the decompressed frame
+    :return: the compressed blocks and the block size in bytes, 0 for the default
+    """
+    if buf.size >= HEADER and int.from_bytes(buf[:8], "big") == nbytes:
+        return buf[HEADER:], int.from_bytes(buf[8:HEADER], "big")
+    return buf, 0
+
+
+def block_count(size, block_size):
+    """
+    :return: number of compressed blocks of size elements, the last partial
+        block is compressed in multiples of 8 elements and the rest is copied
+    """
+    return size // block_size + int(size % block_size >= 8)
+
+
+def block_offsets(blocks, count):
+    """
+    every block starts with its compressed size as big endian uint32
+
+    :return: byte offsets of the first count blocks and the end of the last one
+    """
+    view = memoryview(blocks)
+    offsets = [0] * (count + 1)
+    offset = 0
+    for i in range(count):
+        offsets[i] = offset
+        if offset + 4 > len(view):
+            raise ValueError("bslz4 frame is truncated")
+        offset += 4 + _unpack_size(view, offset)[0]
+    if offset > len(view):
+        raise ValueError("bslz4 frame is truncated")
+    offsets[count] = offset
+    return np.array(offsets, dtype=np.int64)
+
+
+class BufferPool:
+    """
+    Reusable output arrays per shape and dtype.
+
+    A buffer is taken with `acquire` and must be given back with `release` once
+    nothing refers to its data anymore, e.g. after the integration of a frame.
+    """
+
+    def __init__(self, keep=2):
+        self.keep = keep
+        self._free = {}
+        self._lock = threading.Lock()
+        self.allocated = 0
+
+    def acquire(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+            self.allocated += 1
+        return np.empty(key[0], dtype=key[1])
+
+    def release(self, arr):
+        key = (arr.shape, arr.dtype)
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if len(free) < self.keep:
+                free.append(arr)
+
+
+class Decoder:
+    """
+    Decodes bitshuffle-lz4 frames from the buffer of the zmq frame into arrays
+    of a BufferPool, neither the compressed nor the decompressed frame is
+    allocated per event.
+
+    With several threads a frame is split into ranges of its independently
+    compressed blocks, which are decoded concurrently into the same array.
+    """
+
+    def __init__(self, pool=None, threads=1):
+        self.pool = pool if pool is not None else BufferPool()
+        self.threads = threads
+        self.executor = None
+        if threads > 1 and _bshuf_decompress_lz4 is not None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix="bslz4"
+            )
+
+    def decode(self, frame, shape, dtype, out=None):
+        """
+        :param frame: zmq.Frame or bytes of a bslz4 compressed image
+        :param out: array to decompress into, by default one from the pool
+        :return: the decompressed array, give it back with `release`
+        """
+        dtype = np.dtype(dtype)
+        if out is None:
+            out = self.pool.acquire(shape, dtype)
+        blocks, block_size = parse_header(frame_view(frame), out.nbytes)
+        if block_size % dtype.itemsize:
+            raise ValueError(f"block size {block_size} is not a multiple of {dtype}")
+        block_size //= dtype.itemsize
+        if _bshuf_decompress_lz4 is None or not out.flags.c_contiguous:
+            out[...] = decompress_lz4(blocks, out.shape, dtype, block_size)
+            return out
+        if block_size == 0:
+            block_size = _bshuf_default_block_size(dtype.itemsize)
+        # the C function trusts the block sizes, a corrupt one would read past
+        # the end of the frame
+        offsets = block_offsets(blocks, block_count(out.size, block_size))
+        if self.executor is not None and out.size // block_size >= 2:
+            self._decode_parallel(blocks, out, block_size, offsets)
+            return out
+        ret = _bshuf_decompress_lz4(
+            blocks.ctypes.data, out.ctypes.data, out.size, dtype.itemsize, block_size
+        )
+        if ret < 0 or ret > blocks.size:
+            raise ValueError(f"error {ret} while decompressing bslz4 frame")
+        return out
+
+    def _decode_parallel(self, blocks, out, block_size, offsets):
+        count = out.size // block_size
+        bounds = np.linspace(0, count, min(self.threads, count) + 1).astype(np.int64)
+        flat = out.reshape(-1)
+
+        def decode_range(first, last):
+            start = first * block_size
+            if last == count:
+                # the last range also has the partial block and the uncompressed rest
+                size = out.size - start
+                available = blocks.size - offsets[first]
+            else:
+                size = (last - first) * block_size
+                available = offsets[last] - offsets[first]
+            ret = _bshuf_decompress_lz4(
+                blocks.ctypes.data + int(offsets[first]),
+                flat[start:].ctypes.data,
+                size,
+                out.dtype.itemsize,
+                block_size,
+            )
+            if ret < 0 or ret > available:
+                raise ValueError(f"error {ret} while decompressing bslz4 frame")
+
+        futures = [
+            self.executor.submit(decode_range, first, last)
+            for first, last in zip(bounds[:-1], bounds[1:])
+        ]
+        for future in futures:
+            future.result()
+
+    def release(self, arr):
+        self.pool.release(arr)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,99 @@
+import logging
+import math
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# approximate bytes of a block read at once
+BLOCK_BYTES = 8 * 2**20
+
+
+class ChunkedReader:
+    """
+    Iterates the rows (first axis) of hdf5 datasets without loading them.
+
+    The rows are read in blocks aligned to the chunks of the first dataset by a
+    background thread, which stays at most `prefetch` blocks ahead of the
+    consumer. Several datasets of the same length are read in lockstep and
+    yielded as tuples, e.g. the fields of the panda. Every iteration starts a
+    new reader thread, which stops when the iteration is abandoned.
+    """
+
+    def __init__(self, datasets, selection=slice(None), prefetch=2, block_bytes=None):
+        self.single = not isinstance(datasets, (list, tuple))
+        self.datasets = [datasets] if self.single else list(datasets)
+        if selection.step is not None and selection.step < 0:
+            raise ValueError("rows are read in increasing order")
+        self.selection = selection
+        self.prefetch = prefetch
+        self.block_rows = self._block_rows(block_bytes or BLOCK_BYTES)
+
+    def _block_rows(self, block_bytes):
+        row_bytes = sum(
+            ds.dtype.itemsize * math.prod(ds.shape[1:]) for ds in self.datasets
+        )
+        rows = max(block_bytes // max(row_bytes, 1), 1)
+        chunks = self.datasets[0].chunks
+        if chunks is not None:
+            rows = max(rows // chunks[0], 1) * chunks[0]
+        return rows
+
+    def __len__(self):
+        return len(range(*self.selection.indices(self.datasets[0].shape[0])))
+
+    def blocks(self):
+        """
+        :return: iterator of the slices of the blocks
+        """
+        start, stop, step = self.selection.indices(self.datasets[0].shape[0])
+        pos = start
+        while pos < stop:
+            end = min((pos // self.block_rows + 1) * self.block_rows, stop)
+            yield slice(pos, end, step)
+            # the first row of the next block on the lattice of the step
+            pos += -(-(end - pos) // step) * step
+
+    def _read(self, out, stop):
+        try:
+            for block in self.blocks():
+                data = [ds[block] for ds in self.datasets]
+                while not stop.is_set():
+                    try:
+                        out.put(data, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            out.put(None)
+        except Exception as e:
+            logger.error("reading %s failed: %s", self.datasets[0].name, e.__repr__())
+            out.put(e)
+
+    def __iter__(self):
+        out = queue.Queue(maxsize=max(self.prefetch, 1))
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._read, args=(out, stop), daemon=True, name="h5-prefetch"
+        )
+        thread.start()
+        try:
+            while True:
+                data = out.get()
+                if data is None:
+                    break
+                if isinstance(data, Exception):
+                    raise data
+                if self.single:
+                    yield from data[0]
+                else:
+                    yield from zip(*data)
+        finally:
+            stop.set()
+            # unblock the reader if it waits for space in the queue
+            while thread.is_alive():
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
@@ -0,0 +1,153 @@
+import math
+import threading
+import time
+
+import numpy as np
+
+# buckets per power of 2, a percentile is at most 2**(1/16) - 1 = 4.4% too high
+SUB_BUCKETS = 16
+# seconds of the first bucket, shorter durations are counted in it
+LOWEST = 1e-6
+# powers of 2 above LOWEST, longer durations are counted in the last bucket
+OCTAVES = 32
+BUCKETS = OCTAVES * SUB_BUCKETS
+
+# seconds between the timings a worker sends with its results
+SEND_INTERVAL = 1.0
+
+
+def bucket(seconds):
+    if seconds <= LOWEST:
+        return 0
+    return min(int(math.log2(seconds / LOWEST) * SUB_BUCKETS), BUCKETS - 1)
+
+
+def upper_edge(index):
+    return LOWEST * 2 ** ((index + 1) / SUB_BUCKETS)
+
+
+class Histogram:
+    """
+    HDR-style histogram of durations with logarithmic buckets, recording is a
+    constant time increment and histograms of several workers merge by adding
+    their counts.
+    """
+
+    def __init__(self):
+        # a list, incrementing an item of an array is several times slower
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bucket(seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """
+        :return: upper edge of the bucket of the q-th percentile, at most the max
+        """
+        if self.count == 0:
+            return 0.0
+        rank = max(math.ceil(q / 100 * self.count), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(upper_edge(index), self.max)
+
+    def to_payload(self):
+        """
+        :return: the non-empty buckets, small enough to send with every result
+        """
+        counts = np.array(self.counts, dtype=np.int64)
+        index = np.flatnonzero(counts)
+        return {
+            "index": index.astype(np.int16),
+            "counts": counts[index],
+            "total": self.total,
+            "max": self.max,
+        }
+
+    def merge(self, payload):
+        for index, count in zip(payload["index"].tolist(), payload["counts"].tolist()):
+            self.counts[index] += count
+        self.count += int(payload["counts"].sum())
+        self.total += payload["total"]
+        self.max = max(self.max, payload["max"])
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Timings:
+    """
+    Histograms of the durations of named stages, e.g. "decompress/pilatus".
+
+    Stages are recorded from several threads, e.g. the fits of the executor.
+    A worker `take`s the histograms since the last call and sends them with a
+    result, the reducer `merge`s them.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        # the first result carries the timings
+        self.since = 0.0
+
+    def record(self, stage, seconds):
+        with self.lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = Histogram()
+            hist.record(seconds)
+
+    def timed(self, stage, fn, *args, **kwargs):
+        """
+        :return: fn(*args, **kwargs), its duration is recorded as stage
+        """
+        start = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        self.record(stage, time.perf_counter() - start)
+        return ret
+
+    def due(self, interval=SEND_INTERVAL):
+        return len(self.stages) > 0 and time.monotonic() - self.since >= interval
+
+    def take(self):
+        """
+        :return: payload of the histograms since the last call
+        """
+        with self.lock:
+            stages = self.stages
+            self.stages = {}
+            self.since = time.monotonic()
+        return {stage: hist.to_payload() for stage, hist in stages.items()}
+
+    def merge(self, payload):
+        with self.lock:
+            for stage, hist in payload.items():
+                self.stages.setdefault(stage, Histogram()).merge(hist)
+
+    def summary(self):
+        """
+        :return: tree of the stages split at "/" with count, mean, p50, p99 and
+            max in seconds
+        """
+        with self.lock:
+            stages = {stage: hist.summary() for stage, hist in self.stages.items()}
+        tree = {}
+        for stage in sorted(stages):
+            *groups, name = stage.split("/")
+            node = tree
+            for group in groups:
+                node = node.setdefault(group, {})
+            node[name] = stages[stage]
+        return tree
@@ -0,0 +1,73 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class FitExecutor:
+    """
+    Runs fits of batches on a small thread pool, NumPy and BLAS release the GIL.
+
+    At most `max_pending` batches are in flight. While the queue is full the
+    caller should keep the spectra in its buffer, they are then fitted with the
+    next, larger batch. Finished batches are handed out in submission order so
+    the published maps grow in the same order as without the executor.
+    """
+
+    def __init__(self, fit, threads=2, max_pending=4):
+        self.fit = fit
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="fit")
+        self.pending = deque()
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.deferred = 0
+        self.last_latency = 0.0
+
+    def full(self):
+        return len(self.pending) >= self.max_pending
+
+    def submit(self, batch, *args, **kwargs):
+        """
+        fits args with the fit function, batch is returned with the result
+        """
+        future = self.pool.submit(self.fit, *args, **kwargs)
+        self.pending.append((time.monotonic(), batch, future))
+        self.submitted += 1
+
+    def collect(self):
+        """
+        :return: list of (batch, result) of the finished batches in order
+        """
+        ret = []
+        while len(self.pending) > 0 and self.pending[0][2].done():
+            submitted, batch, future = self.pending.popleft()
+            self.last_latency = time.monotonic() - submitted
+            try:
+                ret.append((batch, future.result()))
+                self.completed += 1
+            except Exception as e:
+                # a failed batch must not stop the collection of the later ones
+                logger.warning("unable to fit spectra: %s", e.__repr__())
+                self.dropped += 1
+        return ret
+
+    def stats(self):
+        lag = 0.0
+        if len(self.pending) > 0:
+            lag = time.monotonic() - self.pending[0][0]
+        return {
+            "queue_depth": len(self.pending),
+            "lag": lag,
+            "latency": self.last_latency,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "deferred": self.deferred,
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,213 @@
+import logging
+import time
+from threading import Lock
+
+import numpy as np
+from PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit import FastXRFLinearFit
+
+logger = logging.getLogger(__name__)
+
+
+class PreparedFit(FastXRFLinearFit):
+    """
+    FastXRFLinearFit which builds the linear model once and then only solves
+    batches of spectra against it.
+
+    fitMultipleSpectra reconfigures the fit, recalculates the reference
+    spectrum and the derivatives for every call. For a live scan the model does
+    not change, so `prepare` does this once (usually with the first batch) and
+    `fit` only runs the least-squares solve, the refit of negative areas and the
+    mass fractions.
+
+    With the "gemm" solver and no weighting, the pseudo-inverse of the model is
+    calculated once and a batch is solved with a single matrix multiplication.
+    The uncertainties of an unweighted fit do not depend on the data and are
+    taken from the cached covariance.
+    """
+
+    solvers = ["lstsq", "gemm"]
+
+    def __init__(self, mcafit=None, solver="lstsq"):
+        super().__init__(mcafit=mcafit)
+        if solver not in self.solvers:
+            raise ValueError(f"unknown solver {solver}, use one of {self.solvers}")
+        self.solver = solver
+        self.prepared = False
+        self._svd = None
+        self._pinv = None
+        self._sigma = None
+        self._massLock = Lock()
+
+    def prepare(self, y, x=None, ysum=None, weight=0, concentrations=1, livetime=None):
+        x, data, self.mcaIndex, livetime = self._fitParseData(
+            x=x, y=y, livetime=livetime
+        )
+        t0 = time.perf_counter()
+
+        nSpectra = data.size // data.shape[self.mcaIndex]
+        (
+            _,
+            self.config,
+            weight,
+            weightPolicy,
+            self.autotime,
+            self.liveTimeFactor,
+        ) = self._fitConfigure(
+            concentrations=concentrations,
+            livetime=livetime,
+            weight=weight,
+            nSpectra=nSpectra,
+        )
+
+        if ysum is None:
+            if weightPolicy == 1:
+                sumover = "all"
+            elif not concentrations:
+                sumover = "first pixel"
+            else:
+                sumover = "first vector"
+            yref = self._fitReferenceSpectrum(
+                data=data, mcaIndex=self.mcaIndex, sumover=sumover
+            )
+        else:
+            yref = ysum
+
+        self._mcaTheory.setData(
+            x=x,
+            y=yref,
+            xmin=self.config["fit"]["xmin"],
+            xmax=self.config["fit"]["xmax"],
+        )
+        (
+            self.derivatives,
+            self.freeNames,
+            self.nFree,
+            self.nFreeBkg,
+        ) = self._fitCreateModel(dtype=self._fitDtypeCalculation(data))
+        self.anchorslist = self._fitBkgAnchorList(config=self.config)
+
+        iXMin, iXMax = self._fitMcaTrimInfo(x=x)
+        self.sliceChan = slice(iXMin, iXMax)
+
+        if weightPolicy == 2:
+            svd = False
+            sigma_b = None
+        elif weightPolicy == 1:
+            svd = True
+            sigma_b = 1 + np.sqrt(yref[self.sliceChan]) / nSpectra
+            sigma_b = sigma_b.reshape(-1, 1)
+        else:
+            svd = True
+            sigma_b = None
+        self.lstsq_kwargs = {"svd": svd, "sigma_b": sigma_b, "weight": weight}
+        self._svd = None
+        self._pinv = None
+        self._sigma = None
+        if self.solver == "gemm":
+            if weightPolicy == 0:
+                self._prepareGemm()
+            else:
+                logger.warning("gemm solver requires weight=0, falling back to lstsq")
+        self.prepared = True
+        logger.info(
+            "prepared fit model with %d free parameters in %f s",
+            self.nFree,
+            time.perf_counter() - t0,
+        )
+
+    def _prepareGemm(self):
+        # same pseudo-inverse and cutoff as PyMca's unweighted lstsq
+        nChan, nFree = self.derivatives.shape
+        U, s, V = np.linalg.svd(self.derivatives, full_matrices=False)
+        s[s < max(nChan, nFree) * np.finfo(np.float64).eps] = np.inf
+        dummy = V.T * (1.0 / s)
+        self._pinv = np.ascontiguousarray(np.dot(dummy, U.T))
+        self._sigma = np.sqrt(np.diag(np.dot(dummy, dummy.T)))
+
+    def _fitGemmAll(self, data=None, mcaIndex=None, results=None, uncertainties=None):
+        nFree = self._pinv.shape[0]
+        spectra = np.moveaxis(data, mcaIndex, -1)[..., self.sliceChan]
+        chunk = spectra.reshape(-1, spectra.shape[-1]).T.astype(np.float64)
+        if self.config["fit"]["stripflag"]:
+            self._fitBkgSubtract(
+                chunk, config=self.config, anchorslist=self.anchorslist
+            )
+        results.reshape(nFree, -1)[:] = np.dot(self._pinv, chunk)
+        uncertainties.reshape(nFree, -1)[:] = self._sigma[:, np.newaxis]
+
+    def fit(self, y, refit=1, concentrations=1):
+        """
+        fits a batch of spectra against the prepared model
+
+        :return: dict of map type to a tuple of labels and values with one row per label
+        """
+        if not self.prepared:
+            raise RuntimeError("fit model is not prepared")
+        _, data, mcaIndex, _ = self._fitParseData(y=y)
+
+        imageShape = list(data.shape)
+        imageShape.pop(mcaIndex)
+        paramShape = (self.nFree,) + tuple(imageShape)
+        dtypeResult = self._fitDtypeResult(data)
+        results = np.zeros(paramShape, dtype=dtypeResult)
+        uncertainties = np.zeros(paramShape, dtype=dtypeResult)
+
+        if self._pinv is not None:
+            self._fitGemmAll(
+                data=data,
+                mcaIndex=mcaIndex,
+                results=results,
+                uncertainties=uncertainties,
+            )
+        else:
+            # the decomposition of the full model is the same for every batch,
+            # only the refit replaces it with the one of a reduced model
+            lstsq_kwargs = dict(self.lstsq_kwargs, last_svd=self._svd)
+            self._fitLstSqAll(
+                data=data,
+                sliceChan=self.sliceChan,
+                mcaIndex=mcaIndex,
+                derivatives=self.derivatives,
+                fitmodel=None,
+                results=results,
+                uncertainties=uncertainties,
+                config=self.config,
+                anchorslist=self.anchorslist,
+                lstsq_kwargs=lstsq_kwargs,
+            )
+            self._svd = lstsq_kwargs["last_svd"]
+
+        if refit:
+            lstsq_kwargs = dict(self.lstsq_kwargs, last_svd=None)
+            self._fitLstSqNegative(
+                data=data,
+                sliceChan=self.sliceChan,
+                mcaIndex=mcaIndex,
+                derivatives=self.derivatives,
+                fitmodel=None,
+                results=results,
+                uncertainties=uncertainties,
+                config=self.config,
+                anchorslist=self.anchorslist,
+                lstsq_kwargs=lstsq_kwargs,
+                freeNames=self.freeNames,
+                nFreeBkg=self.nFreeBkg,
+                nFreeParameters=None,
+            )
+
+        ret = {
+            "parameters": (self.freeNames, results),
+            "uncertainties": (self.freeNames, uncertainties),
+        }
+        if concentrations:
+            # a fitted reference element modifies the theory and configuration
+            with self._massLock:
+                labels, massfractions = self._fitDeriveMassFractions(
+                    config=self.config,
+                    nFreeBkg=self.nFreeBkg,
+                    results=results,
+                    autotime=self.autotime,
+                    liveTimeFactor=self.liveTimeFactor,
+                )
+            ret["massfractions"] = (labels, massfractions)
+        return ret
@@ -0,0 +1,211 @@
+import logging
+
+import numpy as np
+
+from src.storage import GrowableArray, ImageArray
+
+logger = logging.getLogger(__name__)
+
+# leading points in which the raster is searched
+INFER_MAX_POINTS = 10000
+
+
+def downsample(source, target, iy, ix):
+    """
+    recomputes pixels of the half resolution image target from their 2x2 tiles
+    of source, as the mean of the tile's finite pixels
+
+    :param iy, ix: pixels of source which changed
+    :return: the pixels of target which changed
+    """
+    width = target.shape[1]
+    tiles = np.unique((np.asarray(iy) // 2) * width + np.asarray(ix) // 2)
+    ty, tx = np.divmod(tiles, width)
+    src = source.view
+    total = np.zeros(len(tiles))
+    count = np.zeros(len(tiles))
+    for dy in range(2):
+        sy = 2 * ty + dy
+        for dx in range(2):
+            sx = 2 * tx + dx
+            inside = np.nonzero((sy < src.shape[0]) & (sx < src.shape[1]))[0]
+            values = src[sy[inside], sx[inside]]
+            finite = np.isfinite(values)
+            total[inside[finite]] += values[finite]
+            count[inside[finite]] += 1
+    with np.errstate(invalid="ignore"):
+        target.put((ty, tx), total / count)
+    return ty, tx
+
+
+class RasterGrid:
+    """
+    Regular raster onto which the scattered map positions are binned.
+
+    The width (points per line) and height (lines) may be given, otherwise the
+    width is taken from the jumps back of the fast axis, which requires the first
+    two lines to be complete and of equal length. Snake scans have no jumps
+    back, their width has to be given. The origin and the steps are
+    derived from the first line and the first point of the second line. Images
+    are stored as rows of float32 which grow with the scan.
+
+    With levels > 0 every image has a pyramid of downsampled images by the
+    factors 2, 4, ... 2**levels for overviews. A put only recomputes the
+    pixels of the levels whose tiles contain the new points.
+    """
+
+    def __init__(self, width=0, height=0, levels=0):
+        self.width = width
+        self.height = height
+        self.factors = [2**level for level in range(1, levels + 1)]
+        self.level_axes = []
+        self.x0 = None
+        self.dx = None
+        self.y0 = None
+        self.dy = None
+        self.x_axis = None
+        self.y_axis = GrowableArray(dtype=np.float64, capacity=max(height, 1))
+        self.failed = False
+
+    @property
+    def ready(self):
+        return self.dx is not None
+
+    def infer(self, x, y, events=None):
+        """
+        determines the raster from the positions of the points received so far
+
+        :param x, y: positions sorted by event number
+        :param events: numbers of the points in the scan, from 0, to detect
+            missing points
+        :return: True once the raster is known, False while it may still be
+            found and after it was given up
+        """
+        if self.ready:
+            return True
+        if self.failed or len(x) == 0:
+            return False
+        if events is None:
+            events = np.arange(len(x))
+        events = events[:INFER_MAX_POINTS]
+        # points may arrive out of order, only the consecutive ones from the
+        # first point of the scan form complete lines
+        if events[0] != 0:
+            return False
+        breaks = np.nonzero(np.diff(events) != 1)[0]
+        n = int(breaks[0]) + 1 if len(breaks) > 0 else len(events)
+        if self._infer(x[:n], y[:n]):
+            return True
+        if events[-1] >= INFER_MAX_POINTS - 1 and n < len(events):
+            logger.warning(
+                "no raster as point %d is missing, set grid_width for the grid maps",
+                events[n - 1] + 1,
+            )
+            self.failed = True
+        elif n >= INFER_MAX_POINTS or self._lines_complete(x[:n]):
+            logger.warning(
+                "no raster in the first %d points, e.g. of a snake scan, "
+                "set grid_width for the grid maps",
+                n,
+            )
+            self.failed = True
+        return False
+
+    def _lines_complete(self, x):
+        """
+        whether the first two lines and the first point of the third are in x,
+        assuming the first line ends where the fast axis first turns
+        """
+        nline = self.width
+        if nline <= 0:
+            steps = np.diff(x)
+            jumps = np.nonzero(np.sign(steps) != np.sign(steps[:1]))[0]
+            if len(jumps) == 0:
+                return False
+            nline = int(jumps[0]) + 1
+        return len(x) > 2 * nline
+
+    def _infer(self, x, y):
+        nline = self.width
+        if nline <= 0:
+            steps = np.diff(x)
+            if len(steps) == 0:
+                return False
+            jumps = np.nonzero(np.sign(steps) != np.sign(steps[0]))[0]
+            if len(jumps) < 2:
+                return False
+            nline = int(jumps[0]) + 1
+            if jumps[1] - jumps[0] != nline:
+                return False
+        if nline < 2 or len(x) <= nline:
+            return False
+
+        y0 = float(np.mean(y[:nline]))
+        dy = float(y[nline]) - y0
+        dx = float(x[nline - 1] - x[0]) / (nline - 1)
+        if dx == 0 or dy == 0:
+            return False
+        self.width = nline
+        self.x0, self.dx = float(x[0]), dx
+        self.y0, self.dy = y0, dy
+        self.x_axis = self.x0 + self.dx * np.arange(self.width)
+        for factor in self.factors:
+            x_axis = self._level_axis(self.x0, self.dx, factor, 0, -(-nline // factor))
+            y_axis = GrowableArray(dtype=np.float64, capacity=self._rows(factor))
+            self.level_axes.append((x_axis, y_axis))
+        logger.info(
+            "raster of width %d with x %f + n*%f, y %f + n*%f",
+            self.width,
+            self.x0,
+            self.dx,
+            self.y0,
+            self.dy,
+        )
+        return True
+
+    def indices(self, x, y):
+        ix = np.rint((np.asarray(x) - self.x0) / self.dx).astype(np.int64)
+        iy = np.rint((np.asarray(y) - self.y0) / self.dy).astype(np.int64)
+        np.clip(ix, 0, self.width - 1, out=ix)
+        np.clip(iy, 0, self.height - 1 if self.height > 0 else None, out=iy)
+        return iy, ix
+
+    @staticmethod
+    def _level_axis(start, step, factor, first, last):
+        # a downsampled pixel is at the center of its tile
+        return start + step * (factor * np.arange(first, last) + (factor - 1) / 2)
+
+    def _rows(self, factor):
+        return max(-(-self.height // factor), 1)
+
+    def image(self, factor=1, source=None):
+        return ImageArray(
+            -(-self.width // factor),
+            capacity=self._rows(factor),
+            height=-(-self.height // factor),
+            source=source,
+        )
+
+    def pyramid(self, image):
+        """
+        :return: empty downsampled images of image, one per factor
+        """
+        levels = []
+        for factor in self.factors:
+            levels.append(self.image(factor, source=levels[-1] if levels else image))
+        return levels
+
+    def put(self, image, iy, ix, values, pyramid=()):
+        image.put((iy, ix), values)
+        rows = len(image)
+        if rows > len(self.y_axis):
+            self.y_axis.extend(self.y0 + self.dy * np.arange(len(self.y_axis), rows))
+        source = image
+        for factor, level, (_, y_axis) in zip(self.factors, pyramid, self.level_axes):
+            iy, ix = downsample(source, level, iy, ix)
+            source = level
+            rows = len(level)
+            if rows > len(y_axis):
+                y_axis.extend(
+                    self._level_axis(self.y0, self.dy, factor, len(y_axis), rows)
+                )
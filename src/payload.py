@@ -0,0 +1,194 @@
+import threading
+import time
+
+import numpy as np
+from bitshuffle import compress_lz4, decompress_lz4
+
+
+def fit_window(config, channels, margin=0):
+    """
+    channel range of the spectrum which the fit configuration uses
+
+    :param config: PyMca fit configuration (ConfigDict)
+    :param channels: number of channels of the spectrum
+    :param margin: channels to keep on both sides of the fit region
+    :return: slice of the channels to send
+    """
+    start = max(int(config["fit"]["xmin"]) - margin, 0)
+    stop = min(int(config["fit"]["xmax"]) + 1 + margin, channels)
+    if stop <= start:
+        raise ValueError(f"empty fit window {start}:{stop} for {channels} channels")
+    return slice(start, stop)
+
+
+def lossless_dtype(data):
+    """
+    smallest integer dtype which holds all values of data, other dtypes are kept
+    """
+    if not np.issubdtype(data.dtype, np.integer) or data.size == 0:
+        return data.dtype
+    low, high = int(data.min()), int(data.max())
+    if low >= 0:
+        candidates = [np.uint8, np.uint16, np.uint32]
+    else:
+        candidates = [np.int8, np.int16, np.int32]
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            if info.bits < data.dtype.itemsize * 8:
+                return np.dtype(dtype)
+            break
+    return data.dtype
+
+
+def crop_spectrum(spectrum, window):
+    """
+    :return: payload with the channels of the window in the smallest lossless dtype
+    """
+    counts = spectrum[window]
+    return {
+        "offset": window.start,
+        "channels": spectrum.shape[-1],
+        "counts": counts.astype(lossless_dtype(counts), copy=False),
+    }
+
+
+def spectrum_window(spectrum):
+    """
+    :param spectrum: full spectrum array or cropped payload
+    :return: offset and number of channels of the spectrum
+    """
+    if isinstance(spectrum, dict):
+        return spectrum["offset"], spectrum["counts"].shape[-1]
+    return 0, spectrum.shape[-1]
+
+
+def restore_spectra(spectra, offset, channels, dtype=None):
+    """
+    places full or cropped spectra into the channel frame offset:offset+channels,
+    channels outside of a cropped spectrum are 0
+
+    :return: array of shape (len(spectra), channels)
+    """
+    if dtype is None:
+        dtype = np.result_type(
+            *{(s["counts"] if isinstance(s, dict) else s).dtype for s in spectra}
+        )
+    out = np.zeros((len(spectra), channels), dtype=dtype)
+    for row, spectrum in zip(out, spectra):
+        start, width = spectrum_window(spectrum)
+        counts = spectrum["counts"] if isinstance(spectrum, dict) else spectrum
+        low = max(start, offset)
+        high = min(start + width, offset + channels)
+        if high > low:
+            row[low - offset : high - offset] = counts[low - start : high - start]
+    return out
+
+
+class CompressedArray:
+    """
+    bitshuffle-lz4 compressed array of a result payload
+    """
+
+    __slots__ = ("data", "shape", "dtype")
+
+    def __init__(self, arr):
+        self.shape = arr.shape
+        self.dtype = arr.dtype.str
+        self.data = compress_lz4(np.ascontiguousarray(arr)).tobytes()
+
+    def __getstate__(self):
+        return self.data, self.shape, self.dtype
+
+    def __setstate__(self, state):
+        self.data, self.shape, self.dtype = state
+
+    def decode(self):
+        buf = np.frombuffer(self.data, dtype=np.uint8)
+        return decompress_lz4(buf, self.shape, np.dtype(self.dtype))
+
+
+class PayloadCodec:
+    """
+    Compresses the numeric arrays of at least min_bytes in result payloads with
+    bitshuffle-lz4, inside dicts, lists and tuples.
+
+    Spectra are mostly zeros and low counts, which compress well. The encoded
+    payload carries the sizes and the time of its encoding under "codec", the
+    decoding side adds them up with its decoding time in `stats`.
+    """
+
+    def __init__(self, min_bytes=1024):
+        self.min_bytes = min_bytes
+        self._lock = threading.Lock()
+        self.totals = {
+            "payloads": 0,
+            "raw_bytes": 0,
+            "compressed_bytes": 0,
+            "encode_seconds": 0.0,
+            "decode_seconds": 0.0,
+        }
+
+    def _map(self, obj, fn):
+        if isinstance(obj, dict):
+            return {key: self._map(value, fn) for key, value in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._map(value, fn) for value in obj)
+        return fn(obj)
+
+    def encode(self, payload):
+        """
+        :return: the payload with compressed arrays, unchanged if none is large
+        """
+        start = time.perf_counter()
+        sizes = [0, 0]
+
+        def compress(obj):
+            if (
+                isinstance(obj, np.ndarray)
+                and obj.dtype.kind in "biufc"
+                and obj.nbytes >= self.min_bytes
+            ):
+                compressed = CompressedArray(obj)
+                sizes[0] += obj.nbytes
+                sizes[1] += len(compressed.data)
+                return compressed
+            return obj
+
+        encoded = self._map(payload, compress)
+        if sizes[0] == 0:
+            return payload
+        encoded["codec"] = {
+            "raw_bytes": sizes[0],
+            "compressed_bytes": sizes[1],
+            "encode_seconds": time.perf_counter() - start,
+        }
+        return encoded
+
+    def decode(self, payload):
+        """
+        :return: the payload with the arrays restored
+        """
+        if not isinstance(payload, dict) or "codec" not in payload:
+            return payload
+        start = time.perf_counter()
+        payload = dict(payload)
+        codec = payload.pop("codec")
+        decoded = self._map(
+            payload,
+            lambda obj: obj.decode() if isinstance(obj, CompressedArray) else obj,
+        )
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.totals["payloads"] += 1
+            for key in ["raw_bytes", "compressed_bytes", "encode_seconds"]:
+                self.totals[key] += codec[key]
+            self.totals["decode_seconds"] += elapsed
+        return decoded
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.totals)
+        if stats["compressed_bytes"] > 0:
+            stats["ratio"] = stats["raw_bytes"] / stats["compressed_bytes"]
+        return stats
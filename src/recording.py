@@ -0,0 +1,268 @@
+"""
+Sidecar offset index for recorded ingester streams (.cbors and .pkls).
+
+    python -m src.recording index data/*.cbors
+    python -m src.recording renumber data/fly.cbors --width 41 --gap 2
+"""
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import sys
+import tempfile
+
+import cbor2
+import numpy as np
+from dranspose.event import message_tag_hook
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx.npz"
+
+# json object with the files and the range of events for RecordingSource
+ENVIRONMENT = "RECORDINGS"
+
+
+def _tag_hook(*args):
+    # cbor2 passes (decoder, tag) before version 6 and (tag, immutable) after
+    tag = next(arg for arg in args if isinstance(arg, cbor2.CBORTag))
+    return message_tag_hook(None, tag)
+
+
+def load_message(f, path):
+    """
+    :return: the InternalWorkerMessage at the position of the open file f
+    """
+    if str(path).endswith(".pkls"):
+        return pickle.load(f)
+    return cbor2.load(f, tag_hook=_tag_hook)
+
+
+def index_path(path):
+    return f"{path}{INDEX_SUFFIX}"
+
+
+def fly_numbers(count, width, gap):
+    """
+    event numbers of records numbered consecutively, with gap numbers after
+    every line of width points, e.g. a fly scan which re-arms for every line
+    """
+    records = np.arange(count)
+    return records + (records // width) * gap
+
+
+def build_index(path):
+    """
+    reads every record once
+
+    :return: dict of the index arrays
+    """
+    size = os.path.getsize(path)
+    offsets = []
+    events = []
+    masks = []
+    names = []
+    with open(path, "rb") as f:
+        while f.tell() < size:
+            offsets.append(f.tell())
+            msg = load_message(f, path)
+            events.append(msg.event_number)
+            mask = 0
+            for stream in msg.streams:
+                if stream not in names:
+                    names.append(stream)
+                mask |= 1 << names.index(stream)
+            masks.append(mask)
+        offsets.append(f.tell())
+    logger.info("indexed %d records of %s in %s", len(events), names, path)
+    events = np.array(events, dtype=np.int64)
+    return {
+        "offsets": np.array(offsets, dtype=np.int64),
+        "events": events,
+        "numbers": events.copy(),
+        "streams": np.array(names, dtype=str),
+        "masks": np.array(masks, dtype=np.uint64),
+        "size": np.int64(size),
+        "mtime": np.int64(os.stat(path).st_mtime_ns),
+    }
+
+
+def write_index(path, index):
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **index)
+    os.replace(tmp, index_path(path))
+
+
+def read_index(path):
+    """
+    :return: the index of the recording or None if it is missing or stale
+    """
+    try:
+        with np.load(index_path(path)) as npz:
+            index = {name: npz[name] for name in npz.files}
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+    stat = os.stat(path)
+    if index["size"] != stat.st_size or index["mtime"] != stat.st_mtime_ns:
+        logger.warning("index of %s is stale", path)
+        return None
+    return index
+
+
+class IndexedRecording:
+    """
+    Random access to the records of a recorded stream through its sidecar index.
+
+    The index holds the byte offset of every record, its event number as
+    recorded and the number it is replayed with, which `renumber` changes
+    without rewriting the recording. Every iteration opens its own file, so
+    several readers may read disjoint ranges in parallel.
+    """
+
+    def __init__(self, path, rebuild=False):
+        self.path = str(path)
+        index = None if rebuild else read_index(self.path)
+        if index is None:
+            index = build_index(self.path)
+            write_index(self.path, index)
+        self.index = index
+
+    def __len__(self):
+        return len(self.index["events"])
+
+    @property
+    def streams(self):
+        return [str(name) for name in self.index["streams"]]
+
+    @property
+    def numbers(self):
+        """event numbers of the records as replayed"""
+        return self.index["numbers"]
+
+    def find(self, event_number):
+        """
+        :return: position of the first record of the event
+        """
+        found = np.flatnonzero(self.numbers == event_number)
+        if len(found) == 0:
+            raise KeyError(f"no event {event_number} in {self.path}")
+        return int(found[0])
+
+    def read(self, position):
+        return next(self.records(position, position + 1))
+
+    def records(self, first=0, last=None, stream=None):
+        """
+        :param first, last: range of record positions
+        :param stream: only records which carry this stream
+        :return: iterator of the messages with their replayed event numbers
+        """
+        last = len(self) if last is None else min(last, len(self))
+        mask = None
+        if stream is not None:
+            if stream not in self.streams:
+                return
+            mask = np.uint64(1 << self.streams.index(stream))
+        with open(self.path, "rb") as f:
+            f.seek(int(self.index["offsets"][first]))
+            for position in range(first, last):
+                if mask is not None and not self.index["masks"][position] & mask:
+                    f.seek(int(self.index["offsets"][position + 1]))
+                    continue
+                msg = load_message(f, self.path)
+                msg.event_number = int(self.numbers[position])
+                yield msg
+
+    def messages(self, start=None, stop=None, stream=None):
+        """
+        :return: iterator of the messages of the events [start, stop)
+        """
+        inside = np.ones(len(self), dtype=bool)
+        if start is not None:
+            inside &= self.numbers >= start
+        if stop is not None:
+            inside &= self.numbers < stop
+        positions = np.flatnonzero(inside)
+        if len(positions) == 0:
+            return iter(())
+        first, last = int(positions[0]), int(positions[-1]) + 1
+        return (
+            msg
+            for msg in self.records(first, last, stream)
+            if (start is None or msg.event_number >= start)
+            and (stop is None or msg.event_number < stop)
+        )
+
+    def split(self, parts):
+        """
+        :return: (first, last) record positions of parts ranges of equal size
+        """
+        bounds = np.linspace(0, len(self), parts + 1).astype(int)
+        return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def renumber(self, numbers):
+        """
+        replays the records with other event numbers, stored in the index
+
+        :param numbers: new number per record, or dict of recorded to new number
+        """
+        if isinstance(numbers, dict):
+            numbers = [numbers.get(int(evn), int(evn)) for evn in self.index["events"]]
+        numbers = np.asarray(numbers, dtype=np.int64)
+        if numbers.shape != self.index["events"].shape:
+            raise ValueError(f"{len(numbers)} numbers for {len(self)} records")
+        self.index["numbers"] = numbers
+        write_index(self.path, self.index)
+
+
+class RecordingSource:
+    """
+    replay source of recordings, optionally a range of events, configured by
+    the RECORDINGS environment variable, e.g. {"files": [...], "start": 100}
+    """
+
+    def __init__(self):
+        config = json.loads(os.environ.get(ENVIRONMENT, "{}"))
+        self.recordings = [IndexedRecording(path) for path in config.get("files", [])]
+        self.start = config.get("start")
+        self.stop = config.get("stop")
+
+    def get_source_generators(self):
+        return [rec.messages(self.start, self.stop) for rec in self.recordings]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    index = commands.add_parser("index", help="build the index of recordings")
+    index.add_argument("files", nargs="+")
+    renumber = commands.add_parser(
+        "renumber", help="number the records consecutively with gaps between lines"
+    )
+    renumber.add_argument("file")
+    renumber.add_argument("--width", type=int, required=True, help="points per line")
+    renumber.add_argument("--gap", type=int, default=2, help="numbers between lines")
+    renumber.add_argument(
+        "--first", type=int, default=0, help="number of the first record"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "index":
+        for path in args.files:
+            rec = IndexedRecording(path, rebuild=True)
+            print(path, len(rec), "records of", ", ".join(rec.streams))
+    elif args.command == "renumber":
+        rec = IndexedRecording(args.file)
+        rec.renumber(args.first + fly_numbers(len(rec), args.width, args.gap))
+        print(args.file, "events", rec.numbers[0], "to", rec.numbers[-1])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
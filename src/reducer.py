@@ -1,95 +1,515 @@
 import logging
 import tempfile
+import time
 from threading import Lock
 
 import numpy as np
-from PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit import FastXRFLinearFit
 from dranspose.event import ResultData
-from dranspose.parameters import BinaryParameter
+from dranspose.parameters import (
+    BinaryParameter,
+    BoolParameter,
+    FloatParameter,
+    IntParameter,
+    StrParameter,
+)
+
+from src.batching import BatchController
+from src.diagnostics import Timings
+from src.executor import FitExecutor
+from src.fit import PreparedFit
+from src.grid import INFER_MAX_POINTS, RasterGrid
+from src.payload import PayloadCodec, restore_spectra, spectrum_window
+from src.roi import parse_ranges, range_weights
+from src.storage import EventArray, annotate
+from src.writer import ResultWriter
 
 logger = logging.getLogger(__name__)
 
+# seconds between checks for finished batches of the executor
+EXECUTOR_POLL = 0.05
+
+# seconds after the end of the scan until the result file is closed even if
+# results are still pending, e.g. of an aborted scan
+WRITER_TIMEOUT = 60.0
+
+GRID_ATTRS = {
+    "NX_class": "NXdata",
+    "signal": "data",
+    "axes": ["y", "x"],
+    "interpretation": "image",
+}
+
 
 class FluorescenceReducer:
     def __init__(self, parameters=None, *args, **kwargs):
-        self.x = []
-        self.y = []
+        self.x = EventArray(dtype=np.float64)
+        self.y = EventArray(dtype=np.float64)
         self.publish = {
             "map": {},
             "control": {},
             "azint": {"data": []},
         }
+        self.grid = None
+        if parameters["map_grid"].value:
+            self.grid = RasterGrid(
+                width=parameters["grid_width"].value,
+                height=parameters["grid_height"].value,
+                levels=parameters["grid_levels"].value,
+            )
+            self.publish["grid"] = {}
         self.buffer = []
+        self.buffer_since = 0
+        self.fitted = []
+        self.scalars = []
+        self.azint_pending = []
+        self.azint_ranges = {}
+        if "azint_rois" in parameters:
+            self.azint_ranges = parse_ranges(parameters["azint_rois"].value)
+        self.azint_weights = None
         self.buffer_lock = Lock()
-        self.fastFit = FastXRFLinearFit()
+        self.codec = PayloadCodec()
+        self.timings = Timings()
+        self.worker_timings = Timings()
+        self.writer = None
+        self.write_spectra = False
+        self.finished = False
+        self.finished_at = 0.0
+        if "result_file" in parameters and parameters["result_file"].value:
+            path = time.strftime(parameters["result_file"].value)
+            try:
+                self.writer = ResultWriter(path)
+                self.write_spectra = parameters["result_spectra"].value
+            except OSError as e:
+                # e.g. the file of a previous scan, the maps are still published
+                logger.error("not writing results to %s: %s", path, e.__repr__())
+        self.batching = BatchController(
+            target_latency=parameters["batch_target_latency"].value,
+            min_batch=parameters["batch_min"].value,
+            max_batch=parameters["batch_max"].value,
+            max_wait=parameters["batch_max_wait"].value,
+        )
+        self.fastFit = PreparedFit(solver=parameters["fit_solver"].value)
+        # offset and number of channels of the spectra of the fit model
+        self.frame = None
         if "mca_config" in parameters:
             with tempfile.NamedTemporaryFile() as fp:
                 fp.write(parameters["mca_config"].data)
+                fp.flush()
                 self.fastFit.setFitConfigurationFile(fp.name)
+        self.executor = None
+        if parameters["fit_threads"].value > 0:
+            self.executor = FitExecutor(
+                self._fit,
+                threads=parameters["fit_threads"].value,
+                max_pending=parameters["fit_queue"].value,
+            )
 
     @staticmethod
     def describe_parameters():
         params = [
             BinaryParameter(name="mca_config"),
+            StrParameter(name="fit_solver", default="lstsq"),
+            BoolParameter(name="map_grid", default=False),
+            StrParameter(
+                name="azint_rois",
+                description="radial ranges integrated to maps as json, "
+                '{"name": [low, high]} in units of the radial axis',
+                default="",
+            ),
+            IntParameter(name="grid_width", default=0),
+            IntParameter(name="grid_height", default=0),
+            IntParameter(
+                name="grid_levels",
+                description="downsampled levels 2x, 4x, ... of every grid map",
+                default=3,
+            ),
+            IntParameter(
+                name="fit_threads",
+                description="fit batches on a thread pool, 0 fits in the timer",
+                default=0,
+            ),
+            IntParameter(name="fit_queue", default=4),
+            FloatParameter(
+                name="batch_target_latency",
+                description="seconds a single fit should take, sets the batch size",
+                default=0.5,
+            ),
+            IntParameter(name="batch_min", default=1),
+            IntParameter(name="batch_max", default=10000),
+            FloatParameter(
+                name="batch_max_wait",
+                description="seconds before fitting less than batch_min spectra",
+                default=0.5,
+            ),
+            StrParameter(
+                name="result_file",
+                description="hdf5 file the results are written to, with strftime "
+                "placeholders, e.g. /data/visitors/results/%Y%m%d-%H%M%S.h5",
+                default="",
+            ),
+            BoolParameter(
+                name="result_spectra",
+                description="also write the spectra fitted by the reducer",
+                default=False,
+            ),
         ]
         return params
 
     def process_result(self, result: ResultData, parameters=None):
+        start = time.perf_counter()
         if result.payload:
+            result.payload = self.codec.decode(result.payload)
+            if "diagnostics" in result.payload:
+                self.worker_timings.merge(result.payload.pop("diagnostics"))
+            if "eiger" in result.payload:
+                with self.buffer_lock:
+                    self.scalars.append(
+                        (
+                            result.event_number,
+                            result.payload.get("position"),
+                            result.payload["eiger"],
+                        )
+                    )
             if "contrast" in result.payload:
                 # self.publish["control"][result.event_number] = result.payload["control"]
                 logger.info(
                     "got contrast control message %s", result.payload["contrast"]
                 )
             elif "azint" in result.payload:
-                self.publish["azint"]["data"].append(result.payload["azint"])
+                with self.buffer_lock:
+                    self._put_azint(result)
+            elif "fit" in result.payload:
+                with self.buffer_lock:
+                    self.fitted.append(result.payload["fit"])
             elif "spectrum" in result.payload:
                 with self.buffer_lock:
+                    if len(self.buffer) == 0:
+                        self.buffer_since = time.monotonic()
                     self.buffer.append(
-                        (result.payload["position"], result.payload["spectrum"])
+                        (
+                            result.event_number,
+                            result.payload["position"],
+                            result.payload["spectrum"],
+                        )
                     )
+        self.timings.record("process_result", time.perf_counter() - start)
 
     def timer(self):
+        start = time.perf_counter()
         spectra = None
         with self.buffer_lock:  # this prevents concurrent access to adding elements to the buffer and fitting
-            if len(self.buffer) > 0:
-                spectra = np.array([b[1] for b in self.buffer])
-                positions = [b[0] for b in self.buffer]
-                self.buffer = []
+            fitted = self.fitted
+            self.fitted = []
+            scalars = self.scalars
+            self.scalars = []
+            azint = self._take_azint()
+            age = time.monotonic() - self.buffer_since
+            full = self.executor is not None and self.executor.full()
+            ntake = 0
+            if full:
+                # keep the spectra, they are fitted with the next batch
+                self.executor.deferred += 1
+            else:
+                ntake = self.batching.take(len(self.buffer), age)
+            if ntake > 0:
+                # how long the oldest spectrum of the batch waited
+                self.timings.record("buffer_wait", age)
+                events = np.array([b[0] for b in self.buffer[:ntake]])
+                positions = [b[1] for b in self.buffer[:ntake]]
+                spectra = [b[2] for b in self.buffer[:ntake]]
+                self.buffer = self.buffer[ntake:]
+            remaining = len(self.buffer)
+        for fit in fitted:
+            self._store_results(fit["events"], fit["x"], fit["y"], fit["results"])
+        if len(scalars) > 0:
+            self._store_scalars(scalars)
+        if azint is not None:
+            self._store_azint(*azint)
         if spectra is not None:
+            spectra = self.timings.timed("stack", self._spectra, spectra)
             logger.info("process spectra %s", spectra.shape)
-            try:
-                res = self.fastFit.fitMultipleSpectra(
-                    y=spectra, weight=0, refit=1, concentrations=1
+            if self.write_spectra:
+                self.writer.put("spectra", events, spectra)
+            batch = (events, [p["x"] for p in positions], [p["y"] for p in positions])
+            if self._prepare(spectra):
+                if self.executor is not None:
+                    self.executor.submit(batch, spectra)
+                else:
+                    try:
+                        self._store_results(*batch, self._fit(spectra))
+                    except ValueError as e:
+                        logger.warning("unable to fit spectra: %s", e.__repr__())
+        if self.executor is not None:
+            for batch, result in self.executor.collect():
+                self._store_results(*batch, result)
+            self.publish["control"]["executor"] = self.executor.stats()
+
+        interval = self.batching.interval(remaining, age)
+        if self.executor is not None and len(self.executor.pending) > 0:
+            # collect finished batches soon, but do not spin while the queue is full
+            interval = EXECUTOR_POLL if full else min(interval, EXECUTOR_POLL)
+        self.publish["control"]["batch_size"] = self.batching.batch_size()
+        if self.codec.totals["payloads"] > 0:
+            self.publish["control"]["codec"] = self.codec.stats()
+        if self._idle():
+            if self.executor is not None:
+                self.executor.shutdown()
+            if self.writer is not None:
+                self.writer.close()
+        elif self.writer is not None and self._overdue():
+            logger.error(
+                "results pending %.0f s after the end of the scan, closing %s",
+                WRITER_TIMEOUT,
+                self.writer.path,
+            )
+            self.writer.close()
+        if self.writer is not None:
+            self.publish["control"]["writer"] = self.writer.stats()
+        with self.buffer_lock:
+            self.timings.timed("publish", annotate, self.publish)
+        self.timings.record("timer", time.perf_counter() - start)
+        self.publish["diagnostics"] = {
+            "worker": self.worker_timings.summary(),
+            "reducer": self.timings.summary(),
+        }
+        return interval
+
+    def _idle(self):
+        """
+        :return: True once the scan finished and all results are stored
+        """
+        with self.buffer_lock:
+            idle = self.finished and not (
+                self.buffer or self.fitted or self.scalars or self.azint_pending
+            )
+        return idle and (self.executor is None or len(self.executor.pending) == 0)
+
+    def _overdue(self):
+        return self.finished and time.monotonic() - self.finished_at > WRITER_TIMEOUT
+
+    def _fit(self, spectra):
+        start = time.perf_counter()
+        result = self.fastFit.fit(spectra, refit=1, concentrations=1)
+        elapsed = time.perf_counter() - start
+        self.batching.record(len(spectra), elapsed)
+        self.timings.record("fit", elapsed)
+        return result
+
+    def _spectra(self, spectra):
+        """
+        stacks the full or cropped spectra of the workers in the channel frame
+        of the fit model, the first batch sets the frame
+        """
+        windows = {spectrum_window(s) for s in spectra}
+        if self.frame is None:
+            if len(windows) == 1:
+                self.frame = windows.pop()
+            else:
+                channels = max(
+                    s["channels"] if isinstance(s, dict) else s.shape[-1]
+                    for s in spectra
                 )
+                self.frame = (0, channels)
+        if windows == {self.frame} and not isinstance(spectra[0], dict):
+            return np.array(spectra)
+        return restore_spectra(spectra, *self.frame)
+
+    def _prepare(self, spectra):
+        if not self.fastFit.prepared:
+            x = None
+            offset, channels = self.frame
+            if offset > 0:
+                # cropped spectra keep their channel numbers for the calibration
+                x = np.arange(offset, offset + channels)
+            try:
+                self.fastFit.prepare(y=spectra, x=x, weight=0, concentrations=1)
             except ValueError as e:
-                logger.warning("unable to fit spectra: %s", e.__repr__())
-                return 0.5
-            result = res.__dict__
-
-            for maptype in result["_buffers"]:
-                if maptype not in self.publish["map"]:
-                    self.publish["map"][maptype] = {}
-                for label, val in zip(
-                    result["_labels"][maptype], result["_buffers"][maptype]
-                ):
-                    if label not in self.publish["map"][maptype]:
-                        self.publish["map"][maptype][label] = {
-                            "x": self.x,
-                            "y": self.y,
-                            "values": [],
-                        }
-                        self.publish["map"][maptype][f"{label}_attrs"] = {
-                            "NX_class": "NXdata",
-                            "signal": "values",
-                            "axes": ["x", "y"],
-                        }
-                    self.publish["map"][maptype][label]["values"] += val.tolist()
-            self.x += [p["x"] for p in positions]
-            self.y += [p["y"] for p in positions]
+                logger.warning("unable to prepare fit: %s", e.__repr__())
+                return False
+        return True
+
+    def _put_azint(self, result):
+        """
+        writes the I(q) row of a result at its event, the maps of the
+        radial ranges are calculated by the timer
+        """
+        events = np.array([result.event_number])
+        data = result.payload["azint"][np.newaxis]
+        position = result.payload.get("position", {"x": np.nan, "y": np.nan})
+        x, y = np.array([position["x"]]), np.array([position["y"]])
+        if "azint_q" in result.payload:
+            if self.writer is not None and "q" not in self.publish["azint"]:
+                self.writer.set("azint/q", result.payload["azint_q"])
+            self.publish["azint"]["q"] = result.payload["azint_q"]
+            self.publish["azint_attrs"] = {
+                "NX_class": "NXdata",
+                "signal": "data",
+                "axes": [".", "q"],
+            }
+        store = self.publish["azint"]["data"]
+        if not isinstance(store, EventArray):
+            store = EventArray(dtype=np.float32, shape=data.shape[1:])
+            self.publish["azint"]["data"] = store
+        store.put(events, data)
+        self._write("azint/data", events, data)
+        self.azint_pending.append((events, x, y))
+
+    def _take_azint(self):
+        """
+        called with the buffer lock held
+
+        :return: events, positions and rows of the new azint results or None
+        """
+        if len(self.azint_pending) == 0:
+            return None
+        events, x, y = (np.concatenate(a) for a in zip(*self.azint_pending))
+        self.azint_pending = []
+        rows = None
+        if len(self.azint_ranges) > 0:
+            store = self.publish["azint"]["data"]
+            rows = store.view[events - store.offset].copy()
+        return events, x, y, rows
+
+    def _store_azint(self, events, x, y, rows):
+        known = np.isfinite(x) & np.isfinite(y)
+        if known.any():
+            self._put_positions(events[known], x[known], y[known])
+        if rows is None:
+            return
+        if (
+            self.azint_weights is None
+            or self.azint_weights[1].shape[1] != rows.shape[1]
+        ):
+            axis = self.publish["azint"].get("q")
+            if axis is None or len(axis) != rows.shape[1]:
+                logger.warning("no radial axis for the azint rois, using bin numbers")
+                axis = np.arange(rows.shape[1])
+            self.azint_weights = range_weights(axis, self.azint_ranges)
+        names, weights = self.azint_weights
+        values = np.dot(weights, np.nan_to_num(rows, nan=0.0).T)
+        self._store_results(events, None, None, {"azint": (names, values)})
 
-        return 0.5
+    def _store_scalars(self, scalars):
+        """
+        stores the per event scalars of the detector streams as maps, every
+        stream is a map type with one map per scalar
+        """
+        positions = [(evn, pos) for evn, pos, _ in scalars if pos is not None]
+        if len(positions) > 0:
+            events = np.array([evn for evn, _ in positions])
+            self._put_positions(
+                events,
+                [pos["x"] for _, pos in positions],
+                [pos["y"] for _, pos in positions],
+            )
+        streams = {}
+        for evn, _, values in scalars:
+            for stream, vals in values.items():
+                streams.setdefault(stream, []).append((evn, vals))
+        for stream, entries in streams.items():
+            events = np.array([evn for evn, _ in entries])
+            labels = list(entries[0][1])
+            values = np.array(
+                [[vals[label] for label in labels] for _, vals in entries]
+            )
+            self._store_results(events, None, None, {stream: (labels, values.T)})
+
+    def _store_results(self, events, x, y, result):
+        start = time.perf_counter()
+        for maptype, (labels, values) in result.items():
+            if maptype not in self.publish["map"]:
+                self.publish["map"][maptype] = {}
+            for label, val in zip(labels, values):
+                if label not in self.publish["map"][maptype]:
+                    mapvalues = EventArray(dtype=val.dtype)
+                    self.publish["map"][maptype][label] = {
+                        "x": self.x,
+                        "y": self.y,
+                        "values": mapvalues,
+                        "valid": mapvalues.valid,
+                    }
+                    self.publish["map"][maptype][f"{label}_attrs"] = {
+                        "NX_class": "NXdata",
+                        "signal": "values",
+                        "axes": ["x", "y"],
+                    }
+                self.publish["map"][maptype][label]["values"].put(events, val)
+                self._write(f"map/{maptype}/{label}", events, val)
+        if x is not None:
+            self._put_positions(events, x, y)
+        self.publish["control"]["filled"] = self.x.watermark
+        self.publish["control"]["points"] = self.x.count
+        if self.grid is not None:
+            self._update_grid(np.asarray(events))
+        self.timings.record("store", time.perf_counter() - start)
+
+    def _put_positions(self, events, x, y):
+        self.x.put(events, x)
+        self.y.put(events, y)
+        self._write("position/x", events, x)
+        self._write("position/y", events, y)
+
+    def _write(self, name, events, values):
+        if self.writer is not None:
+            self.writer.put(name, events, values)
+
+    def _update_grid(self, events):
+        if not self.grid.ready:
+            if self.grid.failed:
+                return
+            idx = np.nonzero(self.x.valid.view[:INFER_MAX_POINTS])[0]
+            if not self.grid.infer(self.x.view[idx], self.y.view[idx], idx):
+                return
+            # bin all points which arrived before the raster was known
+            events = np.nonzero(self.x.valid.view)[0] + self.x.offset
+        idx = events - self.x.offset
+        # only points with a position, e.g. not detector scalars without the panda
+        idx = idx[idx < len(self.x)]
+        idx = idx[self.x.valid.view[idx]]
+        if len(idx) == 0:
+            return
+        iy, ix = self.grid.indices(self.x.view[idx], self.y.view[idx])
+        for maptype, maps in self.publish["map"].items():
+            grids = self.publish["grid"].setdefault(maptype, {})
+            for label, mp in maps.items():
+                if not isinstance(mp, dict) or "values" not in mp:
+                    continue
+                if label not in grids:
+                    data = self.grid.image()
+                    grids[label] = {
+                        "data": data,
+                        "x": self.grid.x_axis,
+                        "y": self.grid.y_axis,
+                    }
+                    grids[f"{label}_attrs"] = GRID_ATTRS
+                    levels = zip(
+                        self.grid.factors,
+                        self.grid.pyramid(data),
+                        self.grid.level_axes,
+                    )
+                    for factor, image, (x_axis, y_axis) in levels:
+                        grids[label][f"{factor}x"] = {
+                            "data": image,
+                            "x": x_axis,
+                            "y": y_axis,
+                        }
+                        grids[label][f"{factor}x_attrs"] = GRID_ATTRS
+                # maps of other streams may not have reached these events
+                known = idx < len(mp["values"])
+                known[known] = mp["values"].valid.view[idx[known]]
+                self.grid.put(
+                    grids[label]["data"],
+                    iy[known],
+                    ix[known],
+                    mp["values"].view[idx[known]],
+                    pyramid=[grids[label][f"{f}x"]["data"] for f in self.grid.factors],
+                )
 
     def finish(self, parameters=None):
+        with self.buffer_lock:
+            # the timer stores the remaining results, then shuts down the
+            # executor and closes the file
+            self.finished = True
+            self.finished_at = time.monotonic()
         print("finished reducer")
         # print(self.publish)
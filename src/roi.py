@@ -0,0 +1,131 @@
+import io
+import json
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def parse_rects(value):
+    """
+    :param value: json object of roi name to [y0, y1, x0, x1]
+    """
+    if not value:
+        return {}
+    rects = json.loads(value)
+    for name, rect in rects.items():
+        if len(rect) != 4:
+            raise ValueError(f"roi {name} is not [y0, y1, x0, x1]: {rect}")
+    return rects
+
+
+def parse_masks(data):
+    """
+    :param data: npz file of roi name to a mask of the frame shape
+    """
+    if not data:
+        return {}
+    with np.load(io.BytesIO(data)) as npz:
+        return {name: npz[name].astype(bool) for name in npz.files}
+
+
+class RoiReducer:
+    """
+    Reduces detector frames to a few scalars: the sum of every roi, the total
+    counts and the center of mass.
+
+    The flat indices of all rois are computed once per frame shape and
+    concatenated, so the sums of all rois are one gather and one
+    `np.add.reduceat`. Masks only apply to frames of their shape. Pixels at the
+    maximum of the dtype in the first frame of a shape are the detector's
+    masked pixels, they are set to 0 in every frame before reducing.
+    """
+
+    def __init__(self, rects=None, masks=None):
+        self.rects = rects or {}
+        self.masks = masks or {}
+        self._layouts = {}
+
+    def _layout(self, img):
+        if img.shape not in self._layouts:
+            names = []
+            indices = []
+            for name, (y0, y1, x0, x1) in self.rects.items():
+                ys = np.arange(max(y0, 0), min(y1, img.shape[0]))
+                xs = np.arange(max(x0, 0), min(x1, img.shape[1]))
+                names.append(name)
+                indices.append((ys[:, np.newaxis] * img.shape[1] + xs).ravel())
+            for name, mask in self.masks.items():
+                if mask.shape == img.shape:
+                    names.append(name)
+                    indices.append(np.flatnonzero(mask))
+            invalid = None
+            if np.issubdtype(img.dtype, np.integer):
+                invalid = np.flatnonzero(img == np.iinfo(img.dtype).max)
+            starts = np.cumsum([0] + [len(i) for i in indices])[:-1]
+            flat = np.concatenate(indices) if indices else np.empty(0, np.int64)
+            self._layouts[img.shape] = (names, flat, starts, invalid)
+            logger.info("roi layout for %s: %s", img.shape, names)
+        return self._layouts[img.shape]
+
+    def __call__(self, img):
+        """
+        :param img: 2d frame, masked pixels are overwritten in place
+        :return: dict of scalar name to value
+        """
+        if not img.flags.writeable:
+            img = img.copy()
+        names, flat, starts, invalid = self._layout(img)
+        pixels = img.reshape(-1)
+        if invalid is not None and invalid.size > 0:
+            pixels[invalid] = 0
+        rows = img.sum(axis=1, dtype=np.float64)
+        cols = img.sum(axis=0, dtype=np.float64)
+        total = rows.sum()
+        ret = {"total": total, "com_x": np.nan, "com_y": np.nan}
+        if total > 0:
+            ret["com_y"] = np.dot(rows, np.arange(len(rows))) / total
+            ret["com_x"] = np.dot(cols, np.arange(len(cols))) / total
+        if len(names) > 0:
+            sums = np.zeros(len(names))
+            # empty rois would take the value of the next one in reduceat
+            nonempty = np.diff(np.append(starts, len(flat))) > 0
+            if flat.size > 0:
+                reduced = np.add.reduceat(
+                    pixels[flat], starts[nonempty], dtype=np.float64
+                )
+                sums[nonempty] = reduced
+            ret.update(zip(names, sums))
+        return ret
+
+
+def parse_ranges(value):
+    """
+    :param value: json object of name to [low, high] of a radial range
+    """
+    if not value:
+        return {}
+    ranges = json.loads(value)
+    for name, bounds in ranges.items():
+        if len(bounds) != 2 or bounds[0] >= bounds[1]:
+            raise ValueError(f"range {name} is not [low, high]: {bounds}")
+    return ranges
+
+
+def range_weights(axis, ranges):
+    """
+    integration weights of radial ranges, the width of every bin of the axis
+    with its center in [low, high) and 0 elsewhere
+
+    :return: names and array of shape (len(ranges), len(axis))
+    """
+    axis = np.asarray(axis, dtype=np.float64)
+    widths = np.gradient(axis) if len(axis) > 1 else np.ones_like(axis)
+    names = list(ranges)
+    weights = np.zeros((len(names), len(axis)))
+    for row, name in zip(weights, names):
+        low, high = ranges[name]
+        inside = (axis >= low) & (axis < high)
+        row[inside] = np.abs(widths[inside])
+    return names, weights
@@ -0,0 +1,240 @@
+import numpy as np
+
+# events after a missing event until it is taken as an event without a result,
+# e.g. the events of a fly scan which arm the panda for the next line
+GAP_HORIZON = 256
+
+
+class GrowableArray:
+    """
+    Typed array for the publish tree which grows along the first axis.
+
+    The capacity doubles when it is exhausted, so appending is amortized O(1)
+    and no python objects are created per point. Readers (e.g. the h5 rest
+    interface through `np.array(obj)`) get a view of the filled part only.
+
+    `version` counts the writes, a reader which saw the same version before
+    has the current data. `fill` is the number of rows which are final, for
+    an array which is only appended to all rows written so far.
+    """
+
+    def __init__(self, dtype=np.float64, shape=(), capacity=1024, fill_value=None):
+        self.fill_value = fill_value
+        self._data = self._allocate((max(capacity, 1),) + tuple(shape), dtype)
+        self._len = 0
+        self.version = 0
+
+    def _allocate(self, shape, dtype):
+        if self.fill_value is None:
+            return np.empty(shape, dtype=dtype)
+        return np.full(shape, self.fill_value, dtype=dtype)
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def shape(self):
+        return (self._len,) + self._data.shape[1:]
+
+    @property
+    def fill(self):
+        return self._len
+
+    @property
+    def capacity(self):
+        return self._data.shape[0]
+
+    @property
+    def view(self):
+        return self._data[: self._len]
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2 * self.capacity)
+        data = self._allocate((capacity,) + self._data.shape[1:], self._data.dtype)
+        data[: self._len] = self._data[: self._len]
+        self._data = data
+
+    def append(self, value):
+        self.reserve(self._len + 1)
+        self._data[self._len] = value
+        self._len += 1
+        self.version += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._data.dtype)
+        n = values.shape[0]
+        self.reserve(self._len + n)
+        self._data[self._len : self._len + n] = values
+        # only publish the new length once the values are written
+        self._len += n
+        self.version += 1
+
+    def put(self, indices, values):
+        """
+        writes values at arbitrary indices, the length grows to the largest index
+        and the gaps keep the fill value
+
+        indices is an index array for the first axis or a tuple of index arrays
+        """
+        if isinstance(indices, tuple):
+            indices = tuple(np.asarray(i, dtype=np.int64) for i in indices)
+        else:
+            indices = (np.asarray(indices, dtype=np.int64),)
+        rows = indices[0]
+        if rows.size == 0:
+            return
+        if rows.min() < 0:
+            raise IndexError("negative index %d" % rows.min())
+        high = int(rows.max()) + 1
+        self.reserve(high)
+        self._data[indices] = values
+        self._len = max(self._len, high)
+        self.version += 1
+
+    def __getitem__(self, item):
+        return self.view[item]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is not None and dtype != self._data.dtype:
+            return self.view.astype(dtype)
+        if copy:
+            return self.view.copy()
+        return self.view
+
+    def __repr__(self):
+        return f"GrowableArray({self.view!r})"
+
+
+class EventArray(GrowableArray):
+    """
+    GrowableArray which places every point at the index of its event number.
+
+    Workers deliver results out of order, scattering them into place keeps the
+    arrays ordered by event without any sorting. Missing events keep the fill
+    value (NaN for floats) and are marked in the `valid` bitmap. Writing an event
+    again replaces it in place, e.g. after re-fitting a range.
+
+    Results arrive out of order only within the events in flight, a missing
+    event which is `horizon` events behind the latest one is taken as a gap of
+    the scan and no longer holds back the watermark.
+    """
+
+    def __init__(
+        self,
+        dtype=np.float64,
+        shape=(),
+        capacity=1024,
+        fill_value=None,
+        offset=1,
+        horizon=GAP_HORIZON,
+    ):
+        if fill_value is None:
+            fill_value = np.nan if np.issubdtype(dtype, np.inexact) else 0
+        super().__init__(dtype, shape, capacity, fill_value=fill_value)
+        # event 0 is the start message of the streams
+        self.offset = offset
+        self.horizon = horizon
+        self.valid = GrowableArray(dtype=bool, capacity=capacity, fill_value=False)
+        self._watermark = 0
+
+    @property
+    def watermark(self):
+        """
+        number of points from the offset which are filled or gaps, the
+        points after it may still arrive
+        """
+        return self._watermark
+
+    @property
+    def fill(self):
+        """rows which are final, the points after it may still arrive"""
+        return self._watermark
+
+    @property
+    def count(self):
+        return int(np.count_nonzero(self.valid.view))
+
+    def put(self, event_numbers, values):
+        indices = np.asarray(event_numbers, dtype=np.int64) - self.offset
+        super().put(indices, values)
+        self.valid.put(indices, True)
+        pending = self.valid.view[self._watermark :]
+        # missing points this far behind the latest one are gaps
+        stale = min(max(len(pending) - self.horizon, 0), len(pending))
+        pending = pending[stale:]
+        if pending.all():
+            self._watermark += stale + len(pending)
+        else:
+            self._watermark += stale + int(np.argmin(pending))
+
+    def append(self, value):
+        raise TypeError("EventArray is indexed by event number, use put")
+
+    def extend(self, values):
+        raise TypeError("EventArray is indexed by event number, use put")
+
+
+class ImageArray(GrowableArray):
+    """
+    GrowableArray of an image which is written pixel by pixel in any order,
+    e.g. a map binned onto the raster of the scan.
+
+    `fill` is the number of leading rows of which every pixel was written.
+    A downsampled image of `source` takes its rows from 2x2 tiles, they are
+    final once both rows of the source are, the last odd row only when the
+    source reached its `height`.
+    """
+
+    def __init__(self, width, capacity=1024, height=0, source=None):
+        super().__init__(np.float32, (width,), capacity, fill_value=np.nan)
+        # rows of the complete image, 0 while unknown
+        self.height = height
+        self.source = source
+        self.written = None
+        if source is None:
+            self.written = GrowableArray(
+                dtype=bool, shape=(width,), capacity=capacity, fill_value=False
+            )
+        self._watermark = 0
+
+    @property
+    def fill(self):
+        if self.source is None:
+            return self._watermark
+        rows = self.source.fill
+        if 0 < self.source.height <= rows:
+            return -(-rows // 2)
+        return rows // 2
+
+    def put(self, indices, values):
+        super().put(indices, values)
+        if self.written is not None:
+            self.written.put(indices, True)
+            pending = self.written.view[self._watermark :].all(axis=1)
+            if pending.all():
+                self._watermark += len(pending)
+            else:
+                self._watermark += int(np.argmin(pending))
+
+
+def annotate(tree):
+    """
+    publishes the fill and version of every array in the tree as attributes
+    of its dataset, so a viewer can poll the attributes and read only the rows
+    [previous fill:fill] once the version changed
+    """
+    for key, value in list(tree.items()):
+        if isinstance(value, dict) and not key.endswith("_attrs"):
+            annotate(value)
+        elif isinstance(value, GrowableArray):
+            name = f"{key}_attrs"
+            attrs = tree.get(name, {})
+            if attrs.get("version") != value.version:
+                # a new dict, a concurrent reader sees the old or the new one
+                tree[name] = {**attrs, "fill": value.fill, "version": value.version}
@@ -0,0 +1,291 @@
+import datetime
+import itertools
+import json
+import logging
+import os
+import time
+
+import h5py
+import numpy as np
+from bitshuffle import compress_lz4
+from dranspose.data.positioncap import (
+    PositionCapEnd,
+    PositionCapField,
+    PositionCapStart,
+    PositionCapValues,
+)
+from dranspose.data.stream1 import Stream1Data, Stream1End, Stream1Start
+from dranspose.data.xspress3 import XspressEnd, XspressImage, XspressStart
+from dranspose.event import InternalWorkerMessage, StreamData
+
+from src.xrf_source import xspress_meta
+
+logger = logging.getLogger(__name__)
+
+# frame shape and dtype of the area detectors
+DETECTORS = {
+    "eiger-1m": ((1065, 1030), np.uint32),
+    "eiger-4m": ((2167, 2070), np.uint32),
+    "pilatus": ((1043, 981), np.int32),
+}
+
+# json object of keyword arguments which override the ones of the class, as
+# replay creates the source without arguments
+ENVIRONMENT = "SYNTHETIC_SCAN"
+
+
+def detector_frames(shape, dtype, count, photons=0.05, seed=0):
+    """
+    frames with a diffraction ring and a central spot on a sparse Poisson
+    background, the modules gaps are at the maximum of the dtype like the
+    masked pixels of the detectors
+
+    :return: count bslz4 compressed frames
+    """
+    rng = np.random.default_rng(seed)
+    ys, xs = np.indices(shape)
+    cy, cx = shape[0] / 2, shape[1] / 2
+    radius = np.hypot(ys - cy, xs - cx)
+    intensity = (
+        photons
+        + 20 * np.exp(-(radius**2) / 50)
+        + np.exp(-((radius - shape[0] / 4) ** 2) / 20)
+    )
+    frames = []
+    for _ in range(count):
+        image = rng.poisson(intensity).astype(dtype)
+        image[::257, :] = np.iinfo(dtype).max
+        image[:, ::515] = np.iinfo(dtype).max
+        frames.append(compress_lz4(image).tobytes())
+    return frames
+
+
+class SyntheticScan:
+    """
+    Synthetic raster scan of any size for load tests of the pipeline.
+
+    The points are generated lazily line by line, the memory does not depend
+    on the size of the scan. Spectra are the real spectra of `spectra` tiled
+    over the scan and perturbed with Poisson noise. Detector frames are a few
+    precomputed compressible frames which are cycled.
+
+    With `line_gap` events between the lines the panda is armed for every line
+    like in a fly scan (see XRFSourceFly60), the other streams skip the gap
+    events. With a `rate` in events per second, the generators sleep to not
+    send faster.
+    """
+
+    def __init__(
+        self,
+        width=1000,
+        height=1000,
+        line_gap=0,
+        streams=("xspress3", "panda0"),
+        rate=None,
+        step=0.1,
+        spectra="data/scan_000008_xspress3.hdf5",
+        frames=8,
+        seed=0,
+    ):
+        self.width = width
+        self.height = height
+        self.line_gap = line_gap
+        self.streams = list(streams)
+        self.rate = rate
+        self.step = step
+        self.spectra = spectra
+        self.frames = frames
+        self.seed = seed
+        if ENVIRONMENT in os.environ:
+            for key, value in json.loads(os.environ[ENVIRONMENT]).items():
+                if not hasattr(self, key):
+                    raise ValueError(f"unknown option {key} in {ENVIRONMENT}")
+                setattr(self, key, value)
+        if self.line_gap == 1:
+            raise ValueError("a line gap needs 2 events to re-arm the panda")
+        logger.info(
+            "synthetic scan of %dx%d points with %s",
+            self.width,
+            self.height,
+            self.streams,
+        )
+
+    @property
+    def points(self):
+        return self.width * self.height
+
+    def event_number(self, row, col):
+        return 1 + row * (self.width + self.line_gap) + col
+
+    @property
+    def end_event(self):
+        return self.event_number(self.height - 1, self.width - 1) + 1
+
+    def get_source_generators(self):
+        sources = {"xspress3": self.xspress_source, "panda0": self.pcap_source}
+        generators = []
+        for stream in self.streams:
+            if stream in sources:
+                generators.append(sources[stream]())
+            elif stream in DETECTORS:
+                generators.append(self.detector_source(stream))
+            else:
+                raise ValueError(f"no synthetic stream {stream}")
+        return generators
+
+    def _points(self):
+        """
+        :return: iterator of the event number, row and column of every point,
+            throttled to the rate
+        """
+        start = time.monotonic()
+        for index, (row, col) in enumerate(
+            itertools.product(range(self.height), range(self.width))
+        ):
+            if self.rate:
+                delay = start + index / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield self.event_number(row, col), row, col
+
+    def xspress_source(self):
+        with h5py.File(self.spectra, "r") as f:
+            group = f["entry/instrument/xspress3"]
+            spectra = group["data"][:]
+            metas = xspress_meta(group)
+        rng = np.random.default_rng(self.seed)
+
+        yield InternalWorkerMessage(
+            event_number=0,
+            streams={"xspress3": XspressStart(filename="").to_stream_data()},
+        )
+        for frameno, (evn, row, col) in enumerate(self._points()):
+            index = frameno % len(spectra)
+            image = rng.poisson(spectra[index]).astype(spectra.dtype)
+            img = XspressImage(
+                frame=frameno,
+                shape=image.shape,
+                compression="none",
+                type=str(image.dtype),
+                data=image,
+                meta=metas[index],
+            )
+            yield InternalWorkerMessage(
+                event_number=evn, streams={"xspress3": img.to_stream_data()}
+            )
+        yield InternalWorkerMessage(
+            event_number=self.end_event,
+            streams={"xspress3": XspressEnd().to_stream_data()},
+        )
+
+    def pcap_source(self):
+        fields = [
+            PositionCapField(name="INENC2.VAL.Mean", type="double"),
+            PositionCapField(name="INENC3.VAL.Mean", type="double"),
+            PositionCapField(name="PCAP.TS_TRIG.Value", type="double"),
+        ]
+        rearm = self.line_gap >= 2
+
+        def start(evn):
+            msg = PositionCapStart(arm_time=datetime.datetime.utcnow())
+            return InternalWorkerMessage(
+                event_number=evn, streams={"panda0": msg.to_stream_data(fields)}
+            )
+
+        def end(evn):
+            return InternalWorkerMessage(
+                event_number=evn,
+                streams={"panda0": PositionCapEnd().to_stream_data()},
+            )
+
+        yield start(0)
+        for frameno, (evn, row, col) in enumerate(self._points()):
+            if rearm and col == 0 and row > 0:
+                yield end(evn - self.line_gap)
+                yield start(evn - 1)
+            for field, value in zip(
+                fields, (col * self.step, row * self.step, frameno * 0.01)
+            ):
+                field.value = value
+            val = PositionCapValues(fields={f.name: f for f in fields})
+            yield InternalWorkerMessage(
+                event_number=evn, streams={"panda0": val.to_stream_data()}
+            )
+        yield end(self.end_event)
+
+    def detector_source(self, stream):
+        shape, dtype = DETECTORS[stream]
+        frames = detector_frames(shape, dtype, self.frames, seed=self.seed)
+        msg_number = itertools.count(0)
+
+        header = Stream1Start(
+            htype="header", filename="", msg_number=next(msg_number)
+        ).model_dump_json()
+        yield InternalWorkerMessage(
+            event_number=0,
+            streams={stream: StreamData(typ="STINS", frames=[header])},
+        )
+        for frameno, (evn, row, col) in enumerate(self._points()):
+            stins = Stream1Data(
+                htype="image",
+                msg_number=next(msg_number),
+                frame=frameno,
+                shape=shape,
+                compression="bslz4",
+                type=np.dtype(dtype).name,
+            ).model_dump_json()
+            yield InternalWorkerMessage(
+                event_number=evn,
+                streams={
+                    stream: StreamData(
+                        typ="STINS", frames=[stins, frames[frameno % len(frames)]]
+                    )
+                },
+            )
+        end = Stream1End(
+            htype="series_end", msg_number=next(msg_number)
+        ).model_dump_json()
+        yield InternalWorkerMessage(
+            event_number=self.end_event,
+            streams={stream: StreamData(typ="STINS", frames=[end])},
+        )
+
+
+class SyntheticFly(SyntheticScan):
+    """
+    2000x2000 fly scan, the panda is armed for every line
+    """
+
+    def __init__(self, **kwargs):
+        kwargs = {"width": 2000, "height": 2000, "line_gap": 2, **kwargs}
+        super().__init__(**kwargs)
+
+
+class SyntheticPilatus(SyntheticScan):
+    """
+    pilatus frames for the azimuthal integration with the positions
+    """
+
+    def __init__(self, **kwargs):
+        kwargs = {
+            "width": 100,
+            "height": 100,
+            "streams": ("pilatus", "panda0"),
+            **kwargs,
+        }
+        super().__init__(**kwargs)
+
+
+class SyntheticEiger(SyntheticScan):
+    """
+    eiger-4m frames for the roi reduction with the positions
+    """
+
+    def __init__(self, **kwargs):
+        kwargs = {
+            "width": 100,
+            "height": 100,
+            "streams": ("eiger-4m", "panda0"),
+            **kwargs,
+        }
+        super().__init__(**kwargs)
@@ -1,11 +1,13 @@
+import io
 import json
 import logging
 import tempfile
+import time
 
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit import FastXRFLinearFit
 from dranspose.event import EventData
-from dranspose.data.xspress3 import XspressStart, XspressImage
+from dranspose.data.xspress3 import XspressStart, XspressImage, XspressEnd
 from dranspose.data.contrast import ContrastRunning
 from dranspose.data.stream1 import Stream1Data
 from dranspose.data.positioncap import PositionCapValues
@@ -13,12 +15,22 @@ from dranspose.middlewares.contrast import parse as contrast_parse
 from dranspose.middlewares.xspress import parse as xspress_parse
 from dranspose.middlewares.stream1 import parse as stins_parse
 from dranspose.middlewares.positioncap import PositioncapParser
-from dranspose.parameters import StrParameter, BinaryParameter
+from dranspose.parameters import (
+    StrParameter,
+    BinaryParameter,
+    BoolParameter,
+    IntParameter,
+    FloatParameter,
+)
 import numpy as np
 import azint
-import zmq
 
-from bitshuffle import decompress_lz4
+from src.bslz4 import Decoder
+from src.diagnostics import Timings
+from src.fit import PreparedFit
+from src.payload import PayloadCodec, crop_spectrum, fit_window
+from src.roi import RoiReducer, parse_masks, parse_rects
+from src.xspress import ElementSum, parse_elements, sum_dtype
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +42,75 @@ class FluorescenceWorker:
             BinaryParameter(name="poni"),
             StrParameter(name="pcap_channel_x", default="INENC2.VAL.Mean"),
             StrParameter(name="pcap_channel_y", default="INENC3.VAL.Mean"),
+            BoolParameter(
+                name="worker_fit",
+                description="fit the spectra in the workers and only send the results",
+                default=False,
+            ),
+            IntParameter(
+                name="worker_fit_batch",
+                description="spectra per fit in a worker, only 1 is supported as "
+                "the partial batch of a worker is lost at the end of the scan",
+                default=1,
+            ),
+            FloatParameter(name="worker_fit_wait", default=0.5),
+            StrParameter(
+                name="xspress3_elements",
+                description="detector elements of the xspress3 to sum, e.g. 3 or 0-3",
+                default="3",
+            ),
+            StrParameter(
+                name="x3mini_elements",
+                description="detector elements of the x3mini to sum, e.g. 1 or 0,1",
+                default="1",
+            ),
+            BoolParameter(
+                name="spectrum_crop",
+                description="only send the channels of the fit region of mca_config "
+                "in the smallest lossless integer type",
+                default=False,
+            ),
+            IntParameter(
+                name="spectrum_crop_margin",
+                description="channels sent on both sides of the fit region",
+                default=32,
+            ),
+            StrParameter(
+                name="eiger_rois",
+                description='rectangular eiger rois as json, {"name": [y0, y1, x0, x1]}',
+                default="",
+            ),
+            BinaryParameter(
+                name="eiger_roi_masks",
+                description="npz file of named eiger roi masks, used for frames "
+                "of the same shape",
+            ),
+            IntParameter(name="azint_bins", default=100),
+            IntParameter(name="azint_splitting", default=4),
+            BinaryParameter(
+                name="azint_mask",
+                description="npy file of the pixel mask for the azimuthal integration",
+            ),
+            IntParameter(
+                name="decoder_threads",
+                description="threads decoding the blocks of a bslz4 frame concurrently",
+                default=1,
+            ),
+            BoolParameter(
+                name="dead_time_correction",
+                description="weight the elements with their dead-time correction factors",
+                default=False,
+            ),
+            BoolParameter(
+                name="payload_compression",
+                description="bitshuffle-lz4 compress the arrays of the results",
+                default=False,
+            ),
+            IntParameter(
+                name="payload_compression_min",
+                description="bytes of the smallest array which is compressed",
+                default=1024,
+            ),
         ]
         return params
 
@@ -37,92 +118,310 @@ class FluorescenceWorker:
         self.number = 0
         self.ai = None
         self.pcap = PositioncapParser()
+        threads = 1
+        if "decoder_threads" in parameters:
+            threads = parameters["decoder_threads"].value
+        self.decoder = Decoder(threads=threads)
+        self.timings = Timings()
+        self.azint_axis_sent = False
+        rects = {}
+        if "eiger_rois" in parameters:
+            rects = parse_rects(parameters["eiger_rois"].value)
+        masks = {}
+        if "eiger_roi_masks" in parameters:
+            masks = parse_masks(parameters["eiger_roi_masks"].value)
+        self.rois = {
+            stream: RoiReducer(rects, masks) for stream in ["eiger-4m", "eiger-1m"]
+        }
         if "poni_file" in parameters:
             print("par", parameters["poni_file"])
+            self.ai = self._integrator(parameters)
+        dtc = "dead_time_correction" in parameters and bool(
+            parameters["dead_time_correction"].value
+        )
+        self.elements = {}
+        for stream in ["xspress3", "x3mini"]:
+            name = f"{stream}_elements"
+            if name in parameters:
+                self.elements[stream] = ElementSum(
+                    parse_elements(parameters[name].value), dead_time_correction=dtc
+                )
+        self.spectrum_out = None
+        self.crop_config = None
+        self.crop_window = None
+        if "spectrum_crop" in parameters and parameters["spectrum_crop"].value:
+            # dranspose passes every declared parameter, unset ones are empty
+            if parameters["mca_config"].data:
+                self.crop_config = ConfigDict.ConfigDict()
+                with tempfile.NamedTemporaryFile() as fp:
+                    fp.write(parameters["mca_config"].data)
+                    fp.flush()
+                    self.crop_config.read(fp.name)
+            else:
+                logger.warning("spectrum_crop requires the mca_config, sending all")
+        self.codec = None
+        if (
+            "payload_compression" in parameters
+            and parameters["payload_compression"].value
+        ):
+            self.codec = PayloadCodec(parameters["payload_compression_min"].value)
+        self.fit = None
+        self.fit_buffer = []
+        self.fit_since = 0
+        self.fit_batch = 1
+        if "worker_fit" in parameters and parameters["worker_fit"].value:
+            # only one worker gets the end of the series and no event reaches
+            # all workers, so a partial batch might never be flushed
+            if parameters["worker_fit_batch"].value > 1:
+                logger.warning(
+                    "worker_fit_batch %d is not supported, fitting every spectrum",
+                    parameters["worker_fit_batch"].value,
+                )
+            self.fit = PreparedFit(solver=parameters["fit_solver"].value)
             with tempfile.NamedTemporaryFile() as fp:
-                fp.write(parameters["poni_file"].data)
+                fp.write(parameters["mca_config"].data)
                 fp.flush()
-                self.ai = azint.AzimuthalIntegrator(fp.name, 4, 100)
+                self.fit.setFitConfigurationFile(fp.name)
+
+    @staticmethod
+    def _integrator(parameters):
+        """
+        builds the azimuthal integrator from the poni, the mask and the
+        integration parameters
+        """
+        poni = parameters["poni_file"].data
+        mask = None
+        if "azint_mask" in parameters and parameters["azint_mask"].value:
+            mask = np.load(io.BytesIO(parameters["azint_mask"].value))
+        options = {"n_splitting": 4, "radial_bins": 100}
+        if "azint_splitting" in parameters:
+            options["n_splitting"] = parameters["azint_splitting"].value
+        if "azint_bins" in parameters:
+            options["radial_bins"] = parameters["azint_bins"].value
+        kwargs = {} if mask is None else {"mask": mask}
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(poni)
+            fp.flush()
+            return azint.AzimuthalIntegrator(
+                fp.name, options["n_splitting"], options["radial_bins"], **kwargs
+            )
+
+    def _fit(self, parameters, flush=False):
+        """
+        fits the buffered spectra once the micro batch is full, too old or flushed
+        """
+        if len(self.fit_buffer) == 0:
+            return {}
+        if not flush:
+            full = len(self.fit_buffer) >= self.fit_batch
+            waited = time.monotonic() - self.fit_since
+            if not full and waited < parameters["worker_fit_wait"].value:
+                return {}
+        buffer = self.fit_buffer
+        self.fit_buffer = []
+        spectra = self.timings.timed("stack", np.array, [b[3] for b in buffer])
+        try:
+            if not self.fit.prepared:
+                self.fit.prepare(y=spectra, weight=0, concentrations=1)
+            result = self.timings.timed(
+                "fit", self.fit.fit, spectra, refit=1, concentrations=1
+            )
+        except ValueError as e:
+            logger.warning("unable to fit spectra: %s", e.__repr__())
+            return {}
+        return {
+            "fit": {
+                "events": np.array([b[0] for b in buffer]),
+                "x": np.array([b[1] for b in buffer]),
+                "y": np.array([b[2] for b in buffer]),
+                "results": result,
+            }
+        }
+
+    def _spectrum(self, stream, default, spec):
+        """
+        combines the selected elements, a sent spectrum is pickled before the
+        next event, so sums are written into a reused buffer unless the
+        spectrum is kept for a worker fit
+        """
+        if stream not in self.elements:
+            self.elements[stream] = ElementSum(default)
+        combine = self.elements[stream]
+        dtc = spec.meta.get("dtc") if combine.dead_time_correction else None
+        if self.fit is not None or (dtc is None and len(combine.elements) == 1):
+            return combine(spec.data, dtc=dtc)
+        dtype = np.float64 if dtc is not None else sum_dtype(spec.data.dtype)
+        shape = spec.data.shape[1:]
+        if (
+            self.spectrum_out is None
+            or self.spectrum_out.shape != shape
+            or self.spectrum_out.dtype != dtype
+        ):
+            self.spectrum_out = np.empty(shape, dtype=dtype)
+        return combine(spec.data, dtc=dtc, out=self.spectrum_out)
+
+    def _crop(self, spectrum, parameters):
+        if self.crop_config is None:
+            return spectrum
+        channels = spectrum.shape[-1]
+        if self.crop_window is None or self.crop_window[0] != channels:
+            window = fit_window(
+                self.crop_config,
+                channels,
+                margin=parameters["spectrum_crop_margin"].value,
+            )
+            self.crop_window = (channels, window)
+        return crop_spectrum(spectrum, self.crop_window[1])
 
     def _azint(self, event):
         if "pilatus" in event.streams:
             logger.debug("use pilatus data for azint")
             if self.ai is not None:
-                data = stins_parse(event.streams["pilatus"])
+                data = self.timings.timed(
+                    "parse/pilatus", stins_parse, event.streams["pilatus"]
+                )
                 if isinstance(data, Stream1Data):
                     if "bslz4" in data.compression:
-                        bufframe = event.streams["pilatus"].frames[1]
-                        if isinstance(bufframe, zmq.Frame):
-                            bufframe = bufframe.bytes
-                        img = decompress_lz4(bufframe, data.shape, dtype=data.type)
+                        img = self.timings.timed(
+                            "decompress/pilatus",
+                            self.decoder.decode,
+                            event.streams["pilatus"].frames[1],
+                            data.shape,
+                            data.type,
+                        )
                         # print("decomp", img, img.shape)
-                        I, _ = self.ai.integrate(img)
+                        I, _ = self.timings.timed(
+                            "integrate/pilatus", self.ai.integrate, img
+                        )
+                        self.decoder.release(img)
                         logger.info("got I %s", I.shape)
-                        return {"azint": I}
+                        return self._azint_axis({"azint": I})
         return {}
 
+    def _azint_axis(self, ret):
+        """
+        adds the radial axis to the first result of the worker
+        """
+        if not self.azint_axis_sent and hasattr(self.ai, "radial_axis"):
+            ret["azint_q"] = np.asarray(self.ai.radial_axis)
+            self.azint_axis_sent = True
+        return ret
+
     def _eigers(self, event):
         ret = {}
         for stream in ["eiger-4m", "eiger-1m"]:
             if stream in event.streams:
-                data = stins_parse(event.streams[stream])
+                data = self.timings.timed(
+                    f"parse/{stream}", stins_parse, event.streams[stream]
+                )
+                img = None
                 if isinstance(data, Stream1Data):
                     if "bslz4" in data.compression:
-                        bufframe = event.streams[stream].frames[1]
-                        if isinstance(bufframe, zmq.Frame):
-                            bufframe = bufframe.bytes
-                        data.data = decompress_lz4(
-                            bufframe, data.shape, dtype=data.type
+                        img = self.timings.timed(
+                            f"decompress/{stream}",
+                            self.decoder.decode,
+                            event.streams[stream].frames[1],
+                            data.shape,
+                            data.type,
                         )
-                logger.info("got %s %s", stream, data)
-        return ret
+                        data.data = img
+                    if getattr(data, "data", None) is not None:
+                        ret[stream] = self.timings.timed(
+                            f"rois/{stream}", self.rois[stream], data.data
+                        )
+                logger.debug("got %s %s", stream, data)
+                if img is not None:
+                    self.decoder.release(img)
+        if len(ret) > 0:
+            return {"eiger": ret}
+        return {}
 
     def process_event(self, event: EventData, parameters=None, *args, **kwargs):
         logger.debug("using parameters %s", parameters)
+        start = time.perf_counter()
         ret = {}
 
         panda0 = None
         if "panda0" in event.streams:
-            panda0 = self.pcap.parse(event.streams["panda0"])
+            panda0 = self.timings.timed(
+                "parse/panda0", self.pcap.parse, event.streams["panda0"]
+            )
+        position = None
+        if isinstance(panda0, PositionCapValues):
+            position = {
+                "x": panda0.fields[parameters["pcap_channel_x"].value].value,
+                "y": panda0.fields[parameters["pcap_channel_y"].value].value,
+            }
 
         ret.update(self._azint(event))
         ret.update(self._eigers(event))
 
         contrast = None
         if "contrast" in event.streams:
-            contrast = contrast_parse(event.streams["contrast"])
+            contrast = self.timings.timed(
+                "parse/contrast", contrast_parse, event.streams["contrast"]
+            )
             if not isinstance(contrast, ContrastRunning):
                 logger.warning("contrast is %s", contrast)
                 ret["contrast"] = contrast
 
         spectrum = None
-        spec = "absent"
-        if "xspress3" in event.streams:
-            spec = xspress_parse(event.streams["xspress3"])
-            if isinstance(spec, XspressImage):
-                spectrum = spec.data[3]
-
-        if "x3mini" in event.streams:
-            spec = xspress_parse(event.streams["x3mini"])
-            if isinstance(spec, XspressImage):
-                spectrum = spec.data[1]
+        end = False
+        for stream, default in [("xspress3", [3]), ("x3mini", [1])]:
+            if stream in event.streams:
+                spec = self.timings.timed(
+                    f"parse/{stream}", xspress_parse, event.streams[stream]
+                )
+                if isinstance(spec, XspressImage):
+                    spectrum = self.timings.timed(
+                        f"combine/{stream}", self._spectrum, stream, default, spec
+                    )
+                end = end or isinstance(spec, XspressEnd)
 
         logger.debug("contrast: %s", contrast)
         logger.debug("spectrum: %s", spectrum)
 
-        if panda0 is not None and spectrum is not None:
-            if isinstance(panda0, PositionCapValues):
-                px = panda0.fields[parameters["pcap_channel_x"].value].value
-                py = panda0.fields[parameters["pcap_channel_y"].value].value
+        if position is not None and spectrum is not None:
+            if self.fit is None:
+                ret["position"] = position
+                ret["spectrum"] = self._crop(spectrum, parameters)
+            else:
+                if len(self.fit_buffer) == 0:
+                    self.fit_since = time.monotonic()
+                self.fit_buffer.append(
+                    (event.event_number, position["x"], position["y"], spectrum)
+                )
+
+        # scalars and azint frames belong to this event
+        if (
+            ("eiger" in ret or "azint" in ret)
+            and position is not None
+            and "position" not in ret
+        ):
+            ret["position"] = position
+
+        if self.fit is not None:
+            ret.update(self._fit(parameters, flush=end))
 
-                ret["position"] = {"x": px, "y": py}
-                ret["spectrum"] = spectrum
+        self.timings.record("event", time.perf_counter() - start)
 
         #        sx, sy = con.pseudo["x"][0], con.pseudo["y"][0]
         #        logger.debug("process position %s %s", sx, sy)
+        if (len(ret) > 0 and self.timings.due()) or end:
+            # the rest of the timings at the end of the series
+            ret["diagnostics"] = self.timings.take()
         if len(ret) > 0:
+            if self.codec is not None:
+                return self.codec.encode(ret)
             return ret
         # logger.warning("empty worker message %s: %s, %s", event.event_number, panda0, spectrum)
 
     def finish(self, parameters=None):
+        if len(self.fit_buffer) > 0:
+            logger.warning(
+                "dropped %d unfitted spectra of events %s",
+                len(self.fit_buffer),
+                [b[0] for b in self.fit_buffer],
+            )
+        self.decoder.shutdown()
         print("finished")
@@ -0,0 +1,244 @@
+import logging
+import math
+import queue
+import threading
+import time
+
+import bitshuffle.h5
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# approximate bytes of a chunk
+CHUNK_BYTES = 2**20
+
+# seconds between flushes of the written rows to the readers
+FLUSH_INTERVAL = 1.0
+
+
+def chunk_shape(shape, dtype, chunk_bytes=CHUNK_BYTES):
+    """
+    :param shape: shape of a row
+    :return: chunks of whole rows of about chunk_bytes
+    """
+    row_bytes = np.dtype(dtype).itemsize * math.prod(shape)
+    return (max(chunk_bytes // max(row_bytes, 1), 1),) + tuple(shape)
+
+
+def fill_value(dtype):
+    return np.nan if np.issubdtype(dtype, np.inexact) else 0
+
+
+def merge_rows(rows, values):
+    """
+    :return: sorted unique rows and their values, a later row replaces an
+        earlier one like in EventArray
+    """
+    order = np.argsort(rows, kind="stable")
+    rows, values = rows[order], values[order]
+    last = np.append(rows[1:] != rows[:-1], True)
+    return rows[last], values[last]
+
+
+class ResultWriter:
+    """
+    Streams the results of the reducer into a hdf5 file as they are stored.
+
+    Rows are indexed by event number like the EventArrays of the publish tree,
+    so results which arrive out of order land in place and missing events keep
+    the fill value (NaN for floats). `put` and `set` only queue the data, a
+    background thread writes it into chunked, bitshuffle-lz4 compressed
+    datasets and flushes them at most every `flush_interval` seconds.
+
+    The file is in SWMR mode after the first flush, readers open it with
+    `h5py.File(path, "r", swmr=True)` and `refresh()` the datasets to follow.
+    HDF5 can not create datasets in SWMR mode, for a dataset which appears
+    later (e.g. a new map type) the file is reopened and readers have to
+    reopen it to see it.
+    """
+
+    def __init__(self, path, offset=1, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        # event 0 is the start message of the streams
+        self.offset = offset
+        self.flush_interval = flush_interval
+        self.file = h5py.File(path, "w-", libver="latest")
+        self.datasets = {}
+        self.queue = queue.Queue()
+        self.written = 0
+        self.reopened = 0
+        self.busy = 0.0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True, name="writer")
+        self.thread.start()
+        logger.info("writing results to %s", path)
+
+    def put(self, name, events, values):
+        """
+        queues the rows of events of the dataset name, the first axis of
+        values is the event
+        """
+        events = np.asarray(events, dtype=np.int64)
+        if events.size > 0:
+            self._queue(("put", name, events, np.asarray(values)))
+
+    def set(self, name, value, attrs=None):
+        """
+        queues a dataset which is written as a whole, e.g. an axis
+        """
+        self._queue(("set", name, np.asarray(value), attrs))
+
+    def attrs(self, name, attrs):
+        """
+        queues attributes of a group or dataset, it is created as group if missing
+        """
+        self._queue(("attrs", name, attrs))
+
+    def _queue(self, item):
+        if self.closed:
+            logger.warning("%s is closed, dropped %s", self.path, item[1])
+            return
+        self.queue.put(item)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        dirty = set()
+        closing = False
+        while not closing:
+            timeout = max(last_flush + self.flush_interval - time.monotonic(), 0)
+            items = []
+            try:
+                items.append(self.queue.get(timeout=timeout if dirty else None))
+                while True:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            closing = None in items
+            if self.error is None:
+                start = time.perf_counter()
+                try:
+                    if not dirty:
+                        # the interval starts with the first unflushed write
+                        last_flush = time.monotonic()
+                    dirty |= self._write([item for item in items if item is not None])
+                    if dirty and (
+                        closing or time.monotonic() >= last_flush + self.flush_interval
+                    ):
+                        # new datasets of a flush interval need one reopen
+                        if not self.file.swmr_mode:
+                            self.file.swmr_mode = True
+                        for name in dirty:
+                            self.file[name].flush()
+                        dirty = set()
+                        last_flush = time.monotonic()
+                except Exception as e:
+                    logger.error("writing %s failed: %s", self.path, e.__repr__())
+                    self.error = e.__repr__()
+                self.busy += time.perf_counter() - start
+        self.file.close()
+
+    def _write(self, items):
+        """
+        :return: names of the datasets written to
+        """
+        rows = {}
+        for item in items:
+            if item[0] == "put":
+                _, name, events, values = item
+                rows.setdefault(name, []).append((events - self.offset, values))
+        new = {
+            name: parts[0][1] for name, parts in rows.items() if name not in self.file
+        }
+        # datasets and attributes can only be created outside of SWMR mode
+        changes = [item for item in items if item[0] != "put"]
+        if (new or changes) and self.file.swmr_mode:
+            self._reopen()
+        for name, values in new.items():
+            self._create(name, values.shape[1:], values.dtype)
+        for item in changes:
+            if item[0] == "set":
+                _, name, value, attrs = item
+                if name in self.file:
+                    del self.file[name]
+                self.file.create_dataset(name, data=value)
+                self.file[name].attrs.update(attrs or {})
+            elif item[0] == "attrs":
+                _, name, attrs = item
+                if name not in self.file:
+                    self.file.create_group(name)
+                self.file[name].attrs.update(attrs)
+        for name, parts in rows.items():
+            self._put(name, parts)
+        return set(rows)
+
+    def _create(self, name, shape, dtype):
+        self.file.create_dataset(
+            name,
+            shape=(0,) + shape,
+            maxshape=(None,) + shape,
+            dtype=dtype,
+            chunks=chunk_shape(shape, dtype),
+            compression=bitshuffle.h5.H5FILTER,
+            compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4),
+            fillvalue=fill_value(dtype),
+        )
+
+    def _reopen(self):
+        """
+        leaves SWMR mode to create datasets
+        """
+        self.file.close()
+        self.file = h5py.File(self.path, "a", libver="latest")
+        self.datasets = {}
+        self.reopened += 1
+        logger.info("reopened %s for new datasets", self.path)
+
+    def _put(self, name, parts):
+        if name not in self.datasets:
+            self.datasets[name] = self.file[name]
+        ds = self.datasets[name]
+        rows, values = merge_rows(
+            np.concatenate([r for r, _ in parts]),
+            np.concatenate([v for _, v in parts]),
+        )
+        if rows[0] < 0:
+            raise IndexError(f"event before the offset in {name}")
+        high = int(rows[-1]) + 1
+        if high > ds.shape[0]:
+            ds.resize(high, axis=0)
+        if high - rows[0] == len(rows):
+            ds[rows[0] : high] = values
+        else:
+            # one write per contiguous run of rows
+            breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+            for run_rows, run_values in zip(
+                np.split(rows, breaks), np.split(values, breaks)
+            ):
+                ds[run_rows[0] : run_rows[-1] + 1] = run_values
+        self.written += len(rows)
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "pending": self.queue.qsize(),
+            "written": self.written,
+            "reopened": self.reopened,
+            "busy": self.busy,
+            "error": self.error or "",
+            "closed": int(self.closed),
+        }
+
+    @property
+    def closed(self):
+        return not self.thread.is_alive()
+
+    def close(self):
+        """
+        writes the queued data and closes the file
+        """
+        if self.closed:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        logger.info("closed %s, %d rows", self.path, self.written)
@@ -15,6 +15,51 @@ from dranspose.data.positioncap import (
 
 import h5py
 
+from src.chunked_reader import ChunkedReader
+
+
+# datasets of the xspress3 group in the order of the meta frame of the stream
+XSPRESS_META = {
+    "ocr": "output_count_rate",
+    "AllEvents": "all_events",
+    "AllGood": "all_good",
+    "ClockTicks": "clock_ticks",
+    "TotalTicks": "total_ticks",
+    "ResetTicks": "reset_ticks",
+    "event_widths": "event_width",
+    "dtc": "dead_time_correction",
+}
+
+
+def iter_xspress_meta(group, selection=slice(None)):
+    """
+    :return: iterator of the meta dicts of the selected frames, empty dicts if
+        the file has no meta data
+    """
+    if not all(name in group for name in XSPRESS_META.values()):
+        frames = len(range(*selection.indices(group["data"].shape[0])))
+        return itertools.repeat({}, frames)
+    reader = ChunkedReader([group[name] for name in XSPRESS_META.values()], selection)
+    return (dict(zip(XSPRESS_META, row)) for row in reader)
+
+
+def xspress_meta(group, selection=slice(None)):
+    """
+    :return: list of the meta dicts of the selected frames
+    """
+    return list(iter_xspress_meta(group, selection))
+
+
+def pcap_datasets(fd):
+    """
+    :return: the datasets of the panda fields in the order of the stream
+    """
+    return [
+        fd["/entry/measurement/panda0/INENC2.VAL_Mean"],
+        fd["/entry/measurement/panda0/INENC3.VAL_Mean"],
+        fd["/entry/measurement/panda0/PCAP.TS_TRIG_Value"],
+    ]
+
 
 class XRFSource:
     def __init__(self):
@@ -33,14 +78,16 @@ class XRFSource:
 
         frameno = 0
 
-        for image in self.fd["/entry/measurement/xspress3/data"][self.slice]:
+        group = self.fd["/entry/measurement/xspress3"]
+        metas = iter_xspress_meta(group, self.slice)
+        for image, meta in zip(ChunkedReader(group["data"], self.slice), metas):
             img = XspressImage(
                 frame=frameno,
                 shape=image.shape,
                 compression="none",
                 type=str(image.dtype),
                 data=image,
-                meta={},
+                meta=meta,
             )
             yield InternalWorkerMessage(
                 event_number=frameno + 1,
@@ -63,9 +110,12 @@ class XRFSource:
 
         frameno = 0
 
-        for x, y in zip(
-            self.fd["/entry/measurement/pseudo/x"][self.slice],
-            self.fd["/entry/measurement/pseudo/y"][self.slice],
+        for x, y in ChunkedReader(
+            [
+                self.fd["/entry/measurement/pseudo/x"],
+                self.fd["/entry/measurement/pseudo/y"],
+            ],
+            self.slice,
         ):
             img = ContrastRunning(
                 dt=0.1, pseudo={"x": np.array([x]), "y": np.array([y])}
@@ -95,11 +145,7 @@ class XRFSource:
         )
 
         frameno = 0
-        for data in zip(
-            self.fd["/entry/measurement/panda0/INENC2.VAL_Mean"][self.slice],
-            self.fd["/entry/measurement/panda0/INENC3.VAL_Mean"][self.slice],
-            self.fd["/entry/measurement/panda0/PCAP.TS_TRIG_Value"][self.slice],
-        ):
+        for data in ChunkedReader(pcap_datasets(self.fd), self.slice):
             for f, d in zip(fields, data):
                 f.value = d
 
@@ -146,7 +192,7 @@ class XRFSourceFly60:
         frameno = 0
         evn = 0
         line = 0
-        for image in self.fd["/entry/measurement/xspress3/data"][:]:
+        for image in ChunkedReader(self.fd["/entry/measurement/xspress3/data"]):
             if line == self.width:
                 evn += 2
                 line = 0
@@ -175,6 +221,7 @@ class XRFSourceFly60:
     def pcap_source(self):
         # shape 121 * 126
         evn = 0
+        positions = iter(ChunkedReader(pcap_datasets(self.fd)))
         for row in range(self.rows):
             fields = [
                 PositionCapField(name="INENC2.VAL.Mean", type="double"),
@@ -188,17 +235,7 @@ class XRFSourceFly60:
             )
             evn += 1
 
-            for data in zip(
-                self.fd["/entry/measurement/panda0/INENC2.VAL_Mean"][
-                    row * self.width : (row + 1) * self.width
-                ],
-                self.fd["/entry/measurement/panda0/INENC3.VAL_Mean"][
-                    row * self.width : (row + 1) * self.width
-                ],
-                self.fd["/entry/measurement/panda0/PCAP.TS_TRIG_Value"][
-                    row * self.width : (row + 1) * self.width
-                ],
-            ):
+            for data in itertools.islice(positions, self.width):
                 for f, d in zip(fields, data):
                     f.value = d
 
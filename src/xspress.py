@@ -0,0 +1,87 @@
+import numpy as np
+
+
+def parse_elements(value):
+    """
+    parses a selection of detector elements like "3", "0,1,3" or "0-3"
+
+    :return: sorted list of element indices
+    """
+    elements = set()
+    for part in str(value).split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            elements.update(range(int(first), int(last) + 1))
+        else:
+            elements.add(int(part))
+    if len(elements) == 0:
+        raise ValueError(f"no detector elements selected in {value!r}")
+    return sorted(elements)
+
+
+def sum_dtype(dtype):
+    """
+    :return: dtype to sum spectra of dtype in, 64 bit for integers so the
+        counts of several elements do not wrap around
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.unsignedinteger):
+        return np.dtype(np.uint64)
+    if np.issubdtype(dtype, np.integer):
+        return np.dtype(np.int64)
+    return dtype
+
+
+class ElementSum:
+    """
+    Combines the spectra of the selected elements of a frame into one spectrum.
+
+    A single element without correction is returned as a view, several
+    elements are summed in the `sum_dtype` of the data. With dead-time correction the
+    weights are the correction factors of the frame (0 for unused elements) and
+    the frame is reduced with a single matrix-vector product in float64.
+    """
+
+    def __init__(self, elements, dead_time_correction=False):
+        self.elements = list(elements)
+        self.dead_time_correction = dead_time_correction
+        self._weights = None
+
+    def _mask(self, n):
+        if self._weights is None or len(self._weights) != n:
+            if max(self.elements) >= n:
+                raise IndexError(
+                    f"detector element {max(self.elements)} out of range for {n} elements"
+                )
+            self._weights = np.zeros(n)
+            self._weights[self.elements] = 1
+        return self._weights
+
+    def __call__(self, data, dtc=None, out=None):
+        """
+        :param data: array of shape (elements, channels)
+        :param dtc: dead-time correction factor per element, used if enabled
+        :param out: optional preallocated array of shape (channels,) to sum into,
+            of the sum_dtype of data
+        :return: the combined spectrum
+        """
+        mask = self._mask(data.shape[0])
+        if self.dead_time_correction and dtc is not None:
+            weights = mask * np.asarray(dtc, dtype=np.float64)
+            if out is None:
+                return np.dot(weights, data)
+            if out.dtype == np.float64 and out.flags.c_contiguous:
+                return np.dot(weights, data, out=out)
+            out[:] = np.dot(weights, data)
+            return out
+        if len(self.elements) == 1:
+            if out is None:
+                return data[self.elements[0]]
+            out[:] = data[self.elements[0]]
+            return out
+        return np.add.reduce(
+            data[self.elements], axis=0, dtype=sum_dtype(data.dtype), out=out
+        )
@@ -0,0 +1,29 @@
+from src.batching import BatchController
+
+
+def test_batch_size():
+    controller = BatchController(
+        target_latency=0.5, min_batch=10, max_batch=300, max_wait=1
+    )
+    # nothing known about the fit yet
+    assert controller.take(1000, 0) == 300
+
+    controller.record(100, 0.1)
+    assert controller.batch_size() == 300
+    for _ in range(20):
+        controller.record(100, 1.0)
+    assert controller.batch_size() == 50
+    assert controller.take(120, 0) == 50
+    assert controller.interval(70, 0) == 0
+
+    controller.record(1, 100)
+    assert controller.batch_size() == 10
+
+
+def test_wait():
+    controller = BatchController(min_batch=10, max_wait=1)
+    assert controller.take(0, 5) == 0
+    assert controller.take(5, 0.2) == 0
+    assert controller.interval(5, 0.2) == 0.8
+    assert controller.take(5, 1.2) == 5
+    assert controller.interval(0, 0) == 1
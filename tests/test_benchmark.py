@@ -0,0 +1,43 @@
+import json
+
+from src.benchmark import (
+    bench_worker,
+    main,
+    poisson_frames,
+    regressions,
+    run,
+    stins_frames,
+)
+
+
+def test_run():
+    results = run(
+        only=["fit", "bslz4"], batch_sizes=(1, 10), threads=(1, 2), min_time=0
+    )
+    assert set(results) == {"environment", "min_time", "fit", "bslz4"}
+    assert set(results["fit"]) == {"1", "10"}
+    assert results["fit"]["10"]["items"] == 10
+    assert results["bslz4"]["2"]["gb_per_second"] > 0
+
+
+def test_worker():
+    events = stins_frames("eiger-1m", poisson_frames((64, 32), 3))
+    result = bench_worker(events, (("eiger_rois", b'{"a": [0, 8, 0, 8]}'),), 0.1)
+    assert result["items"] > 0
+    assert result["per_second"] > 0
+
+
+def test_baseline(tmp_path):
+    output = tmp_path / "bench.json"
+    assert main(["--only", "bslz4", "--min-time", "0", "--output", str(output)]) == 0
+    results = json.loads(output.read_text())
+
+    faster = json.loads(output.read_text())
+    faster["bslz4"]["1"]["per_second"] *= 100
+    assert [r[0] for r in regressions(results, faster, 0.2)] == ["bslz4/1"]
+    assert regressions(faster, results, 0.2) == []
+
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps(faster))
+    args = ["--only", "bslz4", "--min-time", "0", "--baseline", str(baseline)]
+    assert main(args + ["--output", str(output)]) == 1
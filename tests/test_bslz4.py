@@ -0,0 +1,134 @@
+import json
+import logging
+import time
+
+import cbor2
+import numpy as np
+import pytest
+import zmq
+from bitshuffle import compress_lz4, decompress_lz4
+
+from src.bslz4 import BufferPool, Decoder, block_offsets, frame_view, parse_header
+
+logger = logging.getLogger(__name__)
+
+
+def eiger_frame():
+    with open(
+        "data/eigerseiger-4m-ingester-d0b20b4c-3605-4a55-b3c0-2ffc0a3d55ed.cbors", "rb"
+    ) as f:
+        cbor2.load(f)
+        header, data = cbor2.load(f).value[1]["eiger-4m"].value[1]
+    header = json.loads(header)
+    return data, header["shape"], header["type"]
+
+
+def test_decode():
+    decoder = Decoder()
+
+    data, shape, dtype = eiger_frame()
+    img = decoder.decode(zmq.Frame(data), shape, dtype)
+    blocks, block_size = parse_header(frame_view(data), img.nbytes)
+    assert block_size == 8192
+    expected = decompress_lz4(blocks, tuple(shape), np.dtype(dtype), block_size // 4)
+    assert np.array_equal(img, expected)
+    decoder.release(img)
+    assert decoder.decode(data, shape, dtype) is img
+    assert decoder.pool.allocated == 1
+
+    # frames without the header, as compressed by the pilatus source
+    image = np.arange(1043 * 981, dtype=np.int32).reshape(1043, 981)
+    img = decoder.decode(compress_lz4(image).tobytes(), image.shape, image.dtype)
+    assert np.array_equal(img, image)
+
+    with pytest.raises(ValueError):
+        decoder.decode(data[:12] + b"\xff" * 64, shape, dtype)
+    # only the size of the partial last block is corrupt
+    image = np.random.default_rng(0).poisson(3, 5 * 2048 + 1000 + 5).astype(np.uint32)
+    frame = bytearray(compress_lz4(image).tobytes())
+    offset = int(block_offsets(frame_view(frame), 5)[-1])
+    frame[offset : offset + 4] = b"\xff" * 4
+    with pytest.raises(ValueError):
+        decoder.decode(bytes(frame), image.shape, image.dtype)
+
+
+@pytest.mark.parametrize("threads", [2, 3, 8])
+def test_decode_parallel(threads):
+    decoder = Decoder(threads=threads)
+
+    data, shape, dtype = eiger_frame()
+    img = decoder.decode(data, shape, dtype)
+    assert np.array_equal(img, Decoder().decode(data, shape, dtype))
+
+    # partial last block and a rest which is not a multiple of 8 elements
+    image = np.random.default_rng(0).poisson(3, 5 * 2048 + 1000 + 5).astype(np.uint32)
+    img = decoder.decode(compress_lz4(image).tobytes(), image.shape, image.dtype)
+    assert np.array_equal(img, image)
+
+    with pytest.raises(ValueError):
+        decoder.decode(compress_lz4(image).tobytes()[:100], image.shape, image.dtype)
+    # only the size of the partial last block is corrupt
+    frame = bytearray(compress_lz4(image).tobytes())
+    offset = int(block_offsets(frame_view(frame), 5)[-1])
+    frame[offset : offset + 4] = b"\xff" * 4
+    with pytest.raises(ValueError):
+        decoder.decode(bytes(frame), image.shape, image.dtype)
+    decoder.shutdown()
+
+
+def test_pool():
+    pool = BufferPool(keep=1)
+    a = pool.acquire((4, 4), np.uint32)
+    b = pool.acquire((4, 4), np.uint32)
+    pool.release(a)
+    pool.release(b)
+    assert pool.acquire([4, 4], "uint32") is a
+    assert pool.acquire((4, 4), np.uint16).dtype == np.uint16
+    assert pool.allocated == 3
+
+
+@pytest.mark.skipif(
+    "not config.getoption('dev')",
+    reason="explicitly enable --dev elopment tests",
+)
+def test_benchmark():
+    data, shape, dtype = eiger_frame()
+    frame = zmq.Frame(data)
+    decoder = Decoder()
+    nbytes = np.prod(shape) * np.dtype(dtype).itemsize
+    repeat = 50
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        # previous path, copy the frame and allocate the output
+        buf = np.frombuffer(frame.bytes, dtype=np.uint8)
+        blocks, block_size = parse_header(buf, nbytes)
+        decompress_lz4(blocks, tuple(shape), np.dtype(dtype), block_size // 4)
+    copied = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decoder.release(decoder.decode(frame, shape, dtype))
+    pooled = (time.perf_counter() - start) / repeat
+
+    logger.info(
+        "copy+allocate %f ms %f GB/s, zero copy pooled %f ms %f GB/s",
+        copied * 1000,
+        nbytes / copied / 1e9,
+        pooled * 1000,
+        nbytes / pooled / 1e9,
+    )
+
+    for threads in [2, 4, 8]:
+        decoder = Decoder(threads=threads)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decoder.release(decoder.decode(frame, shape, dtype))
+        parallel = (time.perf_counter() - start) / repeat
+        decoder.shutdown()
+        logger.info(
+            "%d threads %f ms %f GB/s",
+            threads,
+            parallel * 1000,
+            nbytes / parallel / 1e9,
+        )
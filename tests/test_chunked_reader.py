@@ -0,0 +1,80 @@
+import threading
+import time
+
+import h5py
+import numpy as np
+import pytest
+from dranspose.data.positioncap import PositionCapValues
+from dranspose.data.xspress3 import XspressImage
+from dranspose.middlewares.positioncap import PositioncapParser
+from dranspose.middlewares.xspress import parse as xspress_parse
+
+from src.chunked_reader import ChunkedReader
+from src.xrf_source import XRFSource, xspress_meta
+
+
+@pytest.fixture
+def datasets(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 1000, (1000, 4, 16), dtype=np.uint32)
+    x = rng.random(1000)
+    with h5py.File(tmp_path / "scan.h5", "w") as f:
+        f.create_dataset("data", data=data, chunks=(7, 4, 16))
+        f.create_dataset("x", data=x)
+    with h5py.File(tmp_path / "scan.h5", "r") as f:
+        yield f, data, x
+
+
+def test_blocks(datasets):
+    f, data, x = datasets
+    reader = ChunkedReader(f["data"], block_bytes=100 * data[0].nbytes)
+    assert reader.block_rows == 98
+    blocks = list(reader.blocks())
+    assert all(b.start % 98 == 0 for b in blocks)
+    assert blocks[-1].stop == 1000
+
+    selection = slice(3, 995, 5)
+    reader = ChunkedReader(f["data"], selection, block_bytes=30 * data[0].nbytes)
+    rows = list(reader)
+    assert len(reader) == len(rows)
+    assert np.array_equal(np.array(rows), data[selection])
+
+    with pytest.raises(ValueError):
+        ChunkedReader(f["data"], slice(None, None, -1))
+
+
+def test_lockstep(datasets):
+    f, data, x = datasets
+    reader = ChunkedReader([f["data"], f["x"]], slice(10, 20), prefetch=1)
+    rows = list(reader)
+    assert len(rows) == 10
+    for i, (image, pos) in enumerate(rows):
+        assert np.array_equal(image, data[10 + i])
+        assert pos == x[10 + i]
+
+
+def test_abandon(datasets):
+    f, data, _ = datasets
+    before = threading.active_count()
+    reader = iter(ChunkedReader(f["data"], block_bytes=data[0].nbytes, prefetch=2))
+    assert np.array_equal(next(reader), data[0])
+    assert threading.active_count() == before + 1
+    reader.close()
+    time.sleep(0.3)
+    assert threading.active_count() == before
+
+
+def test_xrf_source():
+    source = XRFSource()
+    images = [xspress_parse(msg.streams["xspress3"]) for msg in source.xspress_source()]
+    images = [img for img in images if isinstance(img, XspressImage)]
+    parser = PositioncapParser()
+    values = [parser.parse(msg.streams["panda0"]) for msg in source.pcap_source()]
+    values = [val for val in values if isinstance(val, PositionCapValues)]
+    with h5py.File("data/000008.h5", "r") as f:
+        group = f["/entry/measurement/xspress3"]
+        assert np.array_equal([img.data for img in images], group["data"][:10])
+        metas = xspress_meta(group, slice(10))
+        x = f["/entry/measurement/panda0/INENC2.VAL_Mean"][:10]
+    assert len(metas) == len(images) == 10
+    assert [val.fields["INENC2.VAL.Mean"].value for val in values] == list(x)
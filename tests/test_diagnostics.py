@@ -0,0 +1,44 @@
+import numpy as np
+
+from src.diagnostics import Histogram, Timings, bucket, upper_edge
+
+
+def test_histogram():
+    durations = np.random.default_rng(0).lognormal(np.log(1e-3), 1.0, 10000)
+    hist = Histogram()
+    for seconds in durations:
+        hist.record(seconds)
+    assert hist.count == 10000
+    assert hist.max == durations.max()
+    for q in (50, 99):
+        exact = np.percentile(durations, q)
+        assert exact <= hist.percentile(q) <= exact * 1.05
+    assert hist.percentile(100) == hist.max
+
+    assert bucket(0) == 0
+    assert bucket(1e9) == len(hist.counts) - 1
+    assert upper_edge(bucket(0.01)) >= 0.01
+    assert Histogram().summary()["p99"] == 0.0
+
+
+def test_merge():
+    worker = Timings()
+    assert not worker.due()
+    worker.record("decompress/pilatus", 0.002)
+    assert worker.due()
+    assert worker.timed("parse/pilatus", sum, [1, 2]) == 3
+    payload = worker.take()
+    assert set(payload) == {"decompress/pilatus", "parse/pilatus"}
+    assert not worker.due()
+
+    reducer = Timings()
+    reducer.merge(payload)
+    worker.record("decompress/pilatus", 0.004)
+    reducer.merge(worker.take())
+    summary = reducer.summary()
+    assert set(summary) == {"decompress", "parse"}
+    pilatus = summary["decompress"]["pilatus"]
+    assert pilatus["count"] == 2
+    assert pilatus["max"] == 0.004
+    assert np.isclose(pilatus["mean"], 0.003)
+    assert 0.002 <= pilatus["p50"] <= 0.002 * 1.05
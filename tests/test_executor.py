@@ -0,0 +1,39 @@
+import time
+
+from src.executor import FitExecutor
+
+
+def _fit(delay, fail=None):
+    time.sleep(delay)
+    if fail is not None:
+        raise fail("no free parameters")
+    return delay
+
+
+def test_order():
+    executor = FitExecutor(_fit, threads=3, max_pending=3)
+    executor.submit("a", 0.3)
+    executor.submit("b", 0.0)
+    executor.submit("c", 0.1, fail=ValueError)
+    assert executor.full()
+
+    time.sleep(0.05)
+    # b is done but has to wait for a
+    assert executor.collect() == []
+    assert executor.stats()["queue_depth"] == 3
+    assert executor.stats()["lag"] > 0
+
+    time.sleep(0.4)
+    assert executor.collect() == [("a", 0.3), ("b", 0.0)]
+    stats = executor.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["completed"] == 2
+    assert stats["dropped"] == 1
+
+    # any error of a fit only drops its batch
+    executor.submit("d", 0.0, fail=ZeroDivisionError)
+    executor.submit("e", 0.0)
+    time.sleep(0.1)
+    assert executor.collect() == [("e", 0.0)]
+    assert executor.stats()["dropped"] == 2
+    executor.shutdown()
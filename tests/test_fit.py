@@ -9,283 +9,9 @@ import pytest
 from PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit import FastXRFLinearFit
 from PyMca5.PyMcaPhysics.xrf.XRFBatchFitOutput import OutputBuffer
 
-_logger = logging.getLogger(__name__)
-
-
-class SingleFit(FastXRFLinearFit):
-    def __init__(self, mcafit=None):
-        super().__init__()
-
-    def prepareMultipleSpectra(
-        self,
-        x=None,
-        y=None,
-        xmin=None,
-        xmax=None,
-        configuration=None,
-        concentrations=False,
-        ysum=None,
-        weight=None,
-        refit=True,
-        livetime=None,
-        outbuffer=None,
-        save=True,
-        **outbufferinitargs
-    ):
-        """
-        This method performs the actual fit. The y keyword is the only mandatory input argument.
-
-        :param x: 1D array containing the x axis (usually the channels) of the spectra.
-        :param y: nD array containing the spectra
-        :param xmin: lower limit of the fitting region
-        :param xmax: upper limit of the fitting region
-        :param ysum: sum spectrum
-        :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights (slow)
-        :param concentrations: 0 Means no calculation, 1 Calculate elemental concentrations
-        :param refit: if False, no check for negative results. Default is True.
-        :param livetime: It will be used if not different from None and concentrations
-                         are to be calculated by using fundamental parameters with
-                         automatic time. The default is None.
-        :param outbuffer:
-        :param save: set to False to postpone saving the in-memory buffers
-        :return OutputBuffer: works like a dict
-        """
-        # Parse data
-        x, data, self.mcaIndex, livetime = self._fitParseData(
-            x=x, y=y, livetime=livetime
-        )
+from src.fit import PreparedFit
 
-        # Calculation needs buffer for memory allocation (memory or H5)
-        t0 = time.time()
-
-        # Configure fit
-        nSpectra = data.size // data.shape[self.mcaIndex]
-        (
-            configorg,
-            self.config,
-            weight,
-            weightPolicy,
-            self.autotime,
-            self.liveTimeFactor,
-        ) = self._fitConfigure(
-            configuration=configuration,
-            concentrations=concentrations,
-            livetime=livetime,
-            weight=weight,
-            nSpectra=nSpectra,
-        )
-
-        outbuffer = {}
-        outbuffer["configuration"] = configorg
-
-        # Sum spectrum
-        if ysum is None:
-            if weightPolicy == 1:
-                # we need to calculate the sum spectrum
-                # to derive the uncertainties
-                sumover = "all"
-            elif not concentrations:
-                # one spectrum is enough
-                sumover = "first pixel"
-            else:
-                sumover = "first vector"
-            yref = self._fitReferenceSpectrum(
-                data=data, mcaIndex=self.mcaIndex, sumover=sumover
-            )
-        else:
-            yref = ysum
-
-        # Get the basis of the linear models (i.e. derivative to peak areas)
-        if xmin is None:
-            xmin = self.config["fit"]["xmin"]
-        if xmax is None:
-            xmax = self.config["fit"]["xmax"]
-        dtypeCalculcation = self._fitDtypeCalculation(data)
-        self._mcaTheory.setData(x=x, y=yref, xmin=xmin, xmax=xmax)
-        self.derivatives, self.freeNames, nFree, self.nFreeBkg = self._fitCreateModel(
-            dtype=dtypeCalculcation
-        )
-
-        # Background anchor points (if any)
-        self.anchorslist = self._fitBkgAnchorList(config=self.config)
-
-        # MCA trimming: [iXMin:iXMax]
-        iXMin, iXMax = self._fitMcaTrimInfo(x=x)
-        self.sliceChan = slice(iXMin, iXMax)
-        nObs = iXMax - iXMin
-
-        # Least-squares parameters
-        if weightPolicy == 2:
-            # Individual spectrum weights (assumed Poisson)
-            SVD = False
-            sigma_b = None
-        elif weightPolicy == 1:
-            # Average weight from sum spectrum (assume Poisson)
-            # the +1 is to prevent misbehavior due to weights less than 1.0
-            sigma_b = 1 + numpy.sqrt(yref[self.sliceChan]) / nSpectra
-            sigma_b = sigma_b.reshape(-1, 1)
-            SVD = True
-        else:
-            # No weights
-            SVD = True
-            sigma_b = None
-        self.lstsq_kwargs = {"svd": SVD, "sigma_b": sigma_b, "weight": weight}
-
-        # Allocate output buffers
-        stackShape = data.shape
-        imageShape = list(stackShape)
-        imageShape.pop(self.mcaIndex)
-        imageShape = tuple(imageShape)
-        self.paramShape = (nFree,) + imageShape
-        self.dtypeResult = self._fitDtypeResult(data)
-        dataAttrs = {}  # {'units':'counts'})
-        paramAttrs = {"errors": "uncertainties", "default": not concentrations}
-        fitAttrs = {}
-        dataAttrs = {}
-
-        _logger.debug("Configuration elapsed = %f", time.time() - t0)
-        t0 = time.time()
-
-    def fitSingleSpectrum(self, data, refit=0, concentrations=0):
-        logging.warning("param shape %s", self.paramShape)
-        results = np.zeros(self.paramShape, dtype=self.dtypeResult)
-        logging.warning("shapeis %s", results.shape)
-        uncertainties = np.zeros(self.paramShape, dtype=self.dtypeResult)
-
-        outbuffer = {}
-        outbuffer["results"] = results
-        outbuffer["uncertainties"] = uncertainties
-        outbuffer["labels"] = self.freeNames
-        # Fit all spectra
-        # logging.warning("members before %s",(self.sliceChan, self.mcaIndex,
-        #                self.derivatives,
-        #                self.config, self.anchorslist,
-        #                self.lstsq_kwargs))
-        self._fitLstSqAll(
-            data=data,
-            sliceChan=self.sliceChan,
-            mcaIndex=self.mcaIndex,
-            derivatives=self.derivatives,
-            fitmodel=None,
-            results=results,
-            uncertainties=uncertainties,
-            config=self.config,
-            anchorslist=self.anchorslist,
-            lstsq_kwargs=self.lstsq_kwargs,
-        )
-        # Refit spectra with negative peak areas
-        if refit:
-            t0 = time.perf_counter()
-            self._fitLstSqNegative(
-                data=data,
-                sliceChan=self.sliceChan,
-                mcaIndex=self.mcaIndex,
-                derivatives=self.derivatives,
-                fitmodel=None,
-                results=results,
-                uncertainties=uncertainties,
-                config=self.config,
-                anchorslist=self.anchorslist,
-                lstsq_kwargs=self.lstsq_kwargs,
-                freeNames=self.freeNames,
-                nFreeBkg=self.nFreeBkg,
-                nFreeParameters=None,
-            )
-            logging.warning("refit took %f", time.perf_counter() - t0)
-        del self.lstsq_kwargs["last_svd"]
-        # return
-        # Return results as a dictionary
-
-        if concentrations:
-            labels, concentrations = self._fitDeriveMassFractions(
-                config=self.config,
-                nFreeBkg=self.nFreeBkg,
-                results=results,
-                autotime=self.autotime,
-                liveTimeFactor=self.liveTimeFactor,
-            )
-
-            outbuffer["massfractions"] = concentrations
-            outbuffer["massfractions_labels"] = labels
-
-        # logging.warning("members after %s", (self.sliceChan, self.mcaIndex,
-        #                                      self.derivatives,
-        #                                      self.config, self.anchorslist,
-        #                                      self.lstsq_kwargs))
-        return outbuffer
-
-    def _fitLstSqNegative(
-        self, data=None, freeNames=None, nFreeBkg=None, results=None, **kwargs
-    ):
-        """Refit pixels with negative peak areas (remove the parameters from the model)"""
-        nFree = len(freeNames)
-        iIter = 1
-        nIter = 2 * (nFree - nFreeBkg) + iIter
-        logging.warning("max iters %d", nIter)
-        nIter = 2
-        negativePresent = True
-        while negativePresent:
-            # Pixels with negative peak areas
-            negList = []
-            for iFree in range(nFreeBkg, nFree):
-                negMask = results[iFree] < 0
-                nNeg = negMask.sum()
-                if nNeg > 0:
-                    negList.append((nNeg, iFree, negMask))
-
-            # No refit needed when no negative peak areas
-            if not negList:
-                negativePresent = False
-                continue
-
-            # Set negative peak areas to zero when
-            # the maximal iterations is reached
-            if iIter > nIter:
-                for nNeg, iFree, negMask in negList:
-                    results[iFree][negMask] = 0.0
-                    _logger.warning(
-                        "%d pixels of parameter %s forced to zero",
-                        nNeg,
-                        freeNames[iFree],
-                    )
-                continue
-
-            # Bad pixels: use peak area with the most negative values
-            negList.sort()
-            negList.reverse()
-            badParameters = []
-            badParameters.append(negList[0][1])
-            badMask = negList[0][2]
-
-            # Combine with masks of all other peak areas
-            # (unless none of them has negative pixels)
-            # This is done to prevent endless loops:
-            # if two or more parameters have common negative pixels
-            # and one of them remains negative when forcing other one to zero
-            for iFree, (nNeg, iFree, negMask) in enumerate(negList):
-                if iFree not in badParameters and nNeg:
-                    combMask = badMask & negMask
-                    if combMask.sum():
-                        badParameters.append(iFree)
-                        badMask = combMask
-
-            # Fit with a reduced model (skipped parameters are fixed at zero)
-            badNames = [freeNames[iFree] for iFree in badParameters]
-            nmin = 0.0025 * badMask.size
-            _logger.debug(
-                "Refit iteration #{}. Fixed to zero: {}".format(iIter, badNames)
-            )
-            self._fitLstSqReduced(
-                data=data,
-                mask=badMask,
-                skipParams=badParameters,
-                skipNames=badNames,
-                results=results,
-                nmin=nmin,
-                **kwargs
-            )
-            iIter += 1
-            logging.warning("iterations %d", iIter)
+_logger = logging.getLogger(__name__)
 
 
 @pytest.mark.skipif(
@@ -294,7 +20,7 @@ class SingleFit(FastXRFLinearFit):
 )
 def test_batch():
     trigger = 300
-    fastFit = SingleFit()
+    fastFit = PreparedFit()
     fastFit.setFitConfigurationFile(
         "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg"
     )
@@ -306,9 +32,7 @@ def test_batch():
     refit = 1
     concentrations = 1
 
-    config = fastFit.prepareMultipleSpectra(
-        y=channel, weight=weight, refit=refit, concentrations=concentrations
-    )
+    fastFit.prepare(y=channel, weight=weight, concentrations=concentrations)
 
     with h5py.File("data/scan_000008_xspress3.hdf5", "r") as f:
         i = 0
@@ -316,13 +40,10 @@ def test_batch():
             channel = f["entry/instrument/xspress3/data"][x : x + 100, 3]
             if channel.shape[0] != 100:
                 break
-            logging.warning("i %s", i)
+            t0 = time.perf_counter()
+            res = fastFit.fit(channel, refit=refit, concentrations=concentrations)
+            logging.warning("batch %d took %f", i, time.perf_counter() - t0)
             i += 1
-            res = fastFit.fitSingleSpectrum(
-                data=channel, refit=refit, concentrations=concentrations
-            )
-    # res2 = fastFit.fitSingleSpectrum(data=channel2, refit=refit, concentrations=concentrations)
-    result = res
 
 
 @pytest.mark.skipif(
@@ -332,42 +53,29 @@ def test_batch():
 # @pytest.mark.parametrize("trigger", [100,400,523,1109])
 def test_seq():
     trigger = 300
-    fastFit = SingleFit()
+    fastFit = PreparedFit()
     fastFit.setFitConfigurationFile(
         "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg"
     )
 
     with h5py.File("data/scan_000008_xspress3.hdf5", "r") as f:
         channel = f["entry/instrument/xspress3/data"][trigger][3:, :]
-        channel2 = f["entry/instrument/xspress3/data"][trigger + 1][3:, :]
 
     weight = 0
     refit = 1
     concentrations = 1
 
-    config = fastFit.prepareMultipleSpectra(
-        y=channel[0], weight=weight, refit=refit, concentrations=concentrations
-    )
+    fastFit.prepare(y=channel[0], weight=weight, concentrations=concentrations)
 
     with h5py.File("data/scan_000008_xspress3.hdf5", "r") as f:
-        i = 0
-        for c in f["entry/instrument/xspress3/data"]:
-            channel = c[3:]
-            logging.warning("i %s", i)
-            i += 1
-            if i > 10:
+        for i, c in enumerate(f["entry/instrument/xspress3/data"]):
+            if i > trigger:
                 break
-            res = fastFit.fitSingleSpectrum(
-                data=channel, refit=refit, concentrations=concentrations
-            )
-    # res2 = fastFit.fitSingleSpectrum(data=channel2, refit=refit, concentrations=concentrations)
+            res = fastFit.fit(c[3], refit=refit, concentrations=concentrations)
     result = res
 
-    logging.warning("massfracs %s", result)
-
-    r = {
-        l: v[0] for l, v in zip(result["massfractions_labels"], result["massfractions"])
-    }
+    labels, values = result["massfractions"]
+    r = {l: v[0] for l, v in zip(labels, values)}
     logging.warning("massfrac dict %s", r)
     with h5py.File("outputDir/IMAGES.h5", "r") as f:
         for l, v in r.items():
@@ -377,6 +85,33 @@ def test_seq():
             assert np.isclose(v, massfrac)
 
 
+def test_prepared():
+    fastFit = FastXRFLinearFit()
+    fastFit.setFitConfigurationFile(
+        "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg"
+    )
+    prepFit = PreparedFit()
+    prepFit.setFitConfigurationFile(
+        "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg"
+    )
+
+    with h5py.File("data/scan_000008_xspress3.hdf5", "r") as f:
+        dataStack = f["entry/instrument/xspress3/data"][400:700, 3]
+
+    prepFit.prepare(y=dataStack[:50], weight=0, concentrations=1)
+    for start in range(0, dataStack.shape[0], 50):
+        batch = dataStack[start : start + 50]
+        res = fastFit.fitMultipleSpectra(
+            y=batch, weight=0, refit=1, concentrations=1
+        ).__dict__
+        result = prepFit.fit(batch, refit=1, concentrations=1)
+
+        assert set(result) == {"parameters", "uncertainties", "massfractions"}
+        for maptype, (labels, values) in result.items():
+            assert list(labels) == list(res["_labels"][maptype])
+            assert np.allclose(values, res["_buffers"][maptype], rtol=1e-4)
+
+
 @pytest.mark.skipif(
     "not config.getoption('dev')",
     reason="explicitly enable --dev elopment tests",
@@ -468,7 +203,7 @@ def test_fullbatch():
 # this test just makes sure that the batch doesn't do magic and fitting one by one give the same result as a batch
 @pytest.mark.parametrize("trigger", [100, 400, 523, 1110])
 def test_iterative(trigger):
-    fastFit = SingleFit()
+    fastFit = FastXRFLinearFit()
     fastFit.setFitConfigurationFile(
         "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg"
     )
@@ -502,3 +237,28 @@ def test_iterative(trigger):
                 "/images/xrf_fit/results/massfractions/" + l.replace(" ", "_")
             ][trigger]
             assert np.isclose(v, massfrac)
+
+
+def test_gemm():
+    fits = {}
+    for solver in PreparedFit.solvers:
+        fits[solver] = PreparedFit(solver=solver)
+        fits[solver].setFitConfigurationFile(
+            "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg"
+        )
+
+    with h5py.File("data/scan_000008_xspress3.hdf5", "r") as f:
+        dataStack = f["entry/instrument/xspress3/data"][400:600, 3]
+
+    results = {}
+    for solver, fit in fits.items():
+        fit.prepare(y=dataStack[:100], weight=0, concentrations=1)
+        results[solver] = [
+            fit.fit(dataStack[start : start + 100], refit=1, concentrations=1)
+            for start in range(0, dataStack.shape[0], 100)
+        ]
+
+    for ref, res in zip(results["lstsq"], results["gemm"]):
+        for maptype, (labels, values) in ref.items():
+            assert list(labels) == list(res[maptype][0])
+            assert np.allclose(values, res[maptype][1], rtol=1e-4, atol=1e-12)
@@ -0,0 +1,133 @@
+import h5py
+import numpy as np
+
+from src.grid import RasterGrid
+
+
+def test_infer():
+    with h5py.File("data/000008.h5", "r") as f:
+        x = f["/entry/measurement/panda0/INENC2.VAL_Mean"][:]
+        y = f["/entry/measurement/panda0/INENC3.VAL_Mean"][:]
+
+    grid = RasterGrid()
+    assert not grid.infer(x[:150], y[:150])
+    events = np.arange(len(x))
+    missing = events != 180
+    assert not grid.infer(x[missing][:250], y[missing][:250], events[missing][:250])
+    assert grid.infer(x[:250], y[:250])
+    assert grid.width == 101
+    assert np.isclose(grid.dx, 0.2, rtol=1e-2)
+    assert np.isclose(grid.dy, 2.0, rtol=1e-2)
+
+    image = grid.image()
+    for start in range(0, len(x), 64):
+        iy, ix = grid.indices(x[start : start + 64], y[start : start + 64])
+        grid.put(image, iy, ix, np.arange(start, min(start + 64, len(x))))
+
+    data = np.array(image)
+    assert data.shape == (11, 101)
+    assert data.dtype == np.float32
+    assert np.array_equal(data.flatten(), np.arange(len(x)))
+    assert np.allclose(grid.y_axis.view, np.linspace(-10, 10, 11), atol=0.05)
+
+
+def test_given_width():
+    x = np.tile(np.linspace(0, 1, 5), 3)
+    y = np.repeat([0.0, 0.5, 1.0], 5)
+
+    grid = RasterGrid(width=5, height=3)
+    assert grid.infer(x, y)
+    image = grid.image()
+    grid.put(image, *grid.indices(x[5:], y[5:]), np.ones(10))
+    data = np.array(image)
+    assert data.shape == (3, 5)
+    assert np.isnan(data[0]).all()
+    assert (data[1:] == 1).all()
+    # rows are final once all of their pixels are written
+    assert image.fill == 0
+    grid.put(image, *grid.indices(x[:4], y[:4]), np.ones(4))
+    assert image.fill == 0
+    grid.put(image, *grid.indices(x[4:5], y[4:5]), np.ones(1))
+    assert image.fill == 3
+
+
+def test_pyramid():
+    rng = np.random.default_rng(1)
+    width, height = 13, 9
+    x = np.tile(np.arange(width, dtype=np.float64), height)
+    y = np.repeat(np.arange(height, dtype=np.float64), width)
+    values = rng.random(width * height)
+
+    grid = RasterGrid(levels=3)
+    assert grid.infer(x, y)
+    assert grid.factors == [2, 4, 8]
+    image = grid.image()
+    pyramid = grid.pyramid(image)
+    order = rng.permutation(len(x))
+    for chunk in np.array_split(order, 7):
+        assert image.fill <= np.count_nonzero(~np.isnan(np.array(image))) // width
+        grid.put(image, *grid.indices(x[chunk], y[chunk]), values[chunk], pyramid)
+    # without a known height the last odd row of a level may still change
+    assert [image.fill] + [level.fill for level in pyramid] == [9, 4, 2, 1]
+    for factor, level in zip([1] + grid.factors, [image] + pyramid):
+        level.height = -(-height // factor)
+    assert [level.fill for level in pyramid] == [5, 3, 2]
+
+    full = values.reshape(height, width)
+    assert np.array_equal(np.array(image), full.astype(np.float32))
+    expected = full
+    for factor, level, (x_axis, y_axis) in zip(grid.factors, pyramid, grid.level_axes):
+        rows, cols = -(-expected.shape[0] // 2), -(-expected.shape[1] // 2)
+        padded = np.full((2 * rows, 2 * cols), np.nan)
+        padded[: expected.shape[0], : expected.shape[1]] = expected
+        expected = np.nanmean(padded.reshape(rows, 2, cols, 2), axis=(1, 3))
+        data = np.array(level)
+        assert data.shape == expected.shape
+        assert np.allclose(data, expected, atol=1e-6)
+        assert np.allclose(x_axis, factor * np.arange(cols) + (factor - 1) / 2)
+        assert np.allclose(y_axis.view, factor * np.arange(rows) + (factor - 1) / 2)
+
+
+def test_snake(caplog):
+    width, height = 50, 30
+    lines = [np.arange(width, dtype=np.float64)] * height
+    x = np.concatenate(
+        [line if i % 2 == 0 else line[::-1] for i, line in enumerate(lines)]
+    )
+    y = np.repeat(np.arange(height, dtype=np.float64), width)
+
+    grid = RasterGrid()
+    # the second line is only complete with the first point of the third
+    assert not grid.infer(x[: 2 * width], y[: 2 * width])
+    assert "snake" not in caplog.text
+    assert not grid.infer(x[: 2 * width + 1], y[: 2 * width + 1])
+    assert grid.failed
+    assert not grid.infer(x, y)
+    assert caplog.text.count("snake") == 1
+
+    grid = RasterGrid(width=width)
+    assert grid.infer(x, y)
+    iy, ix = grid.indices(x, y)
+    assert np.array_equal(ix[width : 2 * width], np.arange(width)[::-1])
+    assert np.array_equal(iy, np.repeat(np.arange(height), width))
+
+
+def test_infer_out_of_order(caplog):
+    with h5py.File("data/000008.h5", "r") as f:
+        x = f["/entry/measurement/panda0/INENC2.VAL_Mean"][:]
+        y = f["/entry/measurement/panda0/INENC3.VAL_Mean"][:]
+
+    rng = np.random.default_rng(8)
+    order = rng.permutation(len(x))
+    # the first point arrives late
+    order = np.concatenate([order[order != 0][:700], [0], order[order != 0][700:]])
+    grid = RasterGrid()
+    received = np.zeros(len(x), dtype=bool)
+    for chunk in np.array_split(order, 100):
+        received[chunk] = True
+        events = np.nonzero(received)[0]
+        if grid.infer(x[events], y[events], events):
+            break
+    assert "no raster" not in caplog.text
+    assert grid.ready and grid.width == 101
+    assert np.isclose(grid.dy, 2.0, rtol=1e-2)
@@ -4,8 +4,14 @@ import time
 from glob import glob
 import cbor2
 
+import h5py
 import h5pyd
-from dranspose.replay import replay
+import numpy as np
+from dranspose.replay import get_parameters, replay
+
+import src.reducer
+from src.reducer import FluorescenceReducer
+from src.worker import FluorescenceWorker
 
 
 def test_map_only(tmp_path):
@@ -78,6 +84,276 @@ def test_map(tmp_path):
     assert list(f["map/massfractions/Fe K/values"].shape) == [slicelen]
     assert list(f["map/massfractions/Ar K/x"].shape) == [slicelen]
     assert list(f["map/massfractions/Ga K/y"].shape) == [slicelen]
+    values = f["map/massfractions/Fe K/values"]
+    assert values.attrs["fill"] == slicelen
+    assert values.attrs["version"] > 0
+    assert list(values[values.attrs["fill"] - 3 : values.attrs["fill"]].shape) == [3]
+
+    fit = f["diagnostics/reducer/fit"]
+    assert fit["count"][()] > 0
+    assert 0 < fit["p50"][()] <= fit["p99"][()] <= fit["max"][()]
+    assert f["diagnostics/worker/parse/xspress3/count"][()] > 0
+    assert f["diagnostics/worker/event/p99"][()] > 0
+
+    stop_event.set()
+
+    thread.join()
+
+
+def test_map_compressed(tmp_path):
+    stop_event = threading.Event()
+    done_event = threading.Event()
+
+    bin_file = tmp_path / "binparams.pkl"
+
+    with open(bin_file, "wb") as f:
+        with open(
+            "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg", "rb"
+        ) as cf:
+            cbor2.dump(
+                [
+                    {"name": "mca_config", "data": cf.read()},
+                    {"name": "payload_compression", "data": b"True"},
+                ],
+                f,
+            )
+
+    thread = threading.Thread(
+        target=replay,
+        args=(
+            "src.worker:FluorescenceWorker",
+            "src.reducer:FluorescenceReducer",
+            None,
+            "src.xrf_source:XRFSource",
+            bin_file,
+        ),
+        kwargs={"port": 5010, "stop_event": stop_event, "done_event": done_event},
+    )
+    thread.start()
+
+    done_event.wait()
+
+    time.sleep(3)  # let the last timer run
+
+    f = h5pyd.File("http://localhost:5010/", "r")
+    assert list(f["map/massfractions/Fe K/values"].shape) == [10]
+    assert f["control/codec/payloads"][()] == 10
+    assert f["control/codec/ratio"][()] > 1
+
+    stop_event.set()
+
+    thread.join()
+
+
+def test_map_file(tmp_path):
+    stop_event = threading.Event()
+    done_event = threading.Event()
+
+    bin_file = tmp_path / "binparams.pkl"
+    result_file = tmp_path / "results.h5"
+
+    with open(bin_file, "wb") as f:
+        with open(
+            "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg", "rb"
+        ) as cf:
+            cbor2.dump(
+                [
+                    {"name": "mca_config", "data": cf.read()},
+                    {"name": "result_file", "data": str(result_file).encode()},
+                    {"name": "result_spectra", "data": b"True"},
+                ],
+                f,
+            )
+
+    thread = threading.Thread(
+        target=replay,
+        args=(
+            "src.worker:FluorescenceWorker",
+            "src.reducer:FluorescenceReducer",
+            None,
+            "src.xrf_source:XRFSource",
+            bin_file,
+        ),
+        kwargs={"port": 5010, "stop_event": stop_event, "done_event": done_event},
+    )
+    thread.start()
+
+    done_event.wait()
+
+    time.sleep(3)  # let the last timer run
+
+    f = h5pyd.File("http://localhost:5010/", "r")
+    assert f["control/writer/closed"][()] == 1
+    assert f["control/writer/error"][()] in ("", b"")
+
+    with h5py.File(result_file, "r") as fd:
+        assert fd["map/massfractions/Fe K"].shape == (10,)
+        assert np.allclose(
+            fd["map/massfractions/Fe K"][:], f["map/massfractions/Fe K/values"][:]
+        )
+        assert fd["position/x"].shape == (10,)
+        assert fd["spectra"].shape[0] == 10
+
+    stop_event.set()
+
+    thread.join()
+
+
+def test_map_file_fallbacks(tmp_path, monkeypatch):
+    bin_file = tmp_path / "binparams.pkl"
+    result_file = tmp_path / "results.h5"
+    result_file.write_bytes(b"previous scan")
+
+    with open(bin_file, "wb") as f:
+        with open(
+            "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg", "rb"
+        ) as cf:
+            cbor2.dump(
+                [
+                    {"name": "mca_config", "data": cf.read()},
+                    {"name": "result_file", "data": str(result_file).encode()},
+                ],
+                f,
+            )
+    parameters = get_parameters(bin_file, FluorescenceWorker, FluorescenceReducer)
+
+    # an existing file is not overwritten and does not stop the reducer
+    reducer = FluorescenceReducer(parameters=parameters)
+    assert reducer.writer is None
+    assert result_file.read_bytes() == b"previous scan"
+
+    # results which never arrive do not keep the file open
+    result_file.unlink()
+    reducer = FluorescenceReducer(parameters=parameters)
+    with reducer.buffer_lock:
+        reducer.buffer.append((5, {"x": 0.0, "y": 0.0}, np.zeros(4096)))
+    reducer.batching.take = lambda *args: 0
+    reducer.finish()
+    reducer.timer()
+    assert not reducer.writer.closed
+    monkeypatch.setattr(src.reducer, "WRITER_TIMEOUT", 0.0)
+    reducer.timer()
+    assert reducer.writer.closed
+
+
+def test_map_grid_partial(tmp_path):
+    bin_file = tmp_path / "binparams.pkl"
+    with open(bin_file, "wb") as f:
+        cbor2.dump(
+            [
+                {"name": "map_grid", "data": b"True"},
+                {"name": "grid_width", "data": b"10"},
+                {"name": "grid_height", "data": b"4"},
+            ],
+            f,
+        )
+    parameters = get_parameters(bin_file, FluorescenceWorker, FluorescenceReducer)
+    reducer = FluorescenceReducer(parameters=parameters)
+
+    events = np.arange(1, 41)
+    x, y = (events - 1) % 10 * 0.5, (events - 1) // 10 * 2.0
+    # the third line is not fitted yet when the scalars of all points arrive
+    fitted = (events < 21) | (events > 30)
+    reducer._store_results(
+        events[fitted],
+        x[fitted],
+        y[fitted],
+        {"massfractions": (["Fe K"], np.full((1, 30), 0.5))},
+    )
+    reducer._store_results(events, x, y, {"eiger-1m": (["total"], np.ones((1, 40)))})
+
+    grid = reducer.publish["grid"]
+    assert grid["eiger-1m"]["total"]["data"].fill == 4
+    fe = grid["massfractions"]["Fe K"]["data"]
+    assert fe.fill == 2
+    assert np.isnan(np.array(fe)[2]).all()
+    assert fe.written.view[3].all() and not fe.written.view[2].any()
+
+
+def test_map_worker_fit(tmp_path):
+    stop_event = threading.Event()
+    done_event = threading.Event()
+
+    bin_file = tmp_path / "binparams.pkl"
+
+    with open(bin_file, "wb") as f:
+        with open(
+            "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg", "rb"
+        ) as cf:
+            cbor2.dump(
+                [
+                    {"name": "mca_config", "data": cf.read()},
+                    {"name": "worker_fit", "data": b"True"},
+                ],
+                f,
+            )
+
+    thread = threading.Thread(
+        target=replay,
+        args=(
+            "src.worker:FluorescenceWorker",
+            "src.reducer:FluorescenceReducer",
+            None,
+            "src.xrf_source:XRFSource",
+            bin_file,
+        ),
+        kwargs={"port": 5010, "stop_event": stop_event, "done_event": done_event},
+    )
+    thread.start()
+
+    done_event.wait()
+
+    time.sleep(1)  # let the last timer run
+
+    f = h5pyd.File("http://localhost:5010/", "r")
+    logging.info("map %s", list(f["map/massfractions"].keys()))
+    assert list(f["map/massfractions/Fe K/values"].shape) == [10]
+    assert list(f["map/parameters/Ga K/x"].shape) == [10]
+    assert f["control/points"][()] == 10
+
+    stop_event.set()
+
+    thread.join()
+
+
+def test_map_cropped(tmp_path):
+    stop_event = threading.Event()
+    done_event = threading.Event()
+
+    bin_file = tmp_path / "binparams.pkl"
+
+    with open(bin_file, "wb") as f:
+        with open(
+            "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg", "rb"
+        ) as cf:
+            cbor2.dump(
+                [
+                    {"name": "mca_config", "data": cf.read()},
+                    {"name": "spectrum_crop", "data": b"True"},
+                ],
+                f,
+            )
+
+    thread = threading.Thread(
+        target=replay,
+        args=(
+            "src.worker:FluorescenceWorker",
+            "src.reducer:FluorescenceReducer",
+            None,
+            "src.xrf_source:XRFSource",
+            bin_file,
+        ),
+        kwargs={"port": 5010, "stop_event": stop_event, "done_event": done_event},
+    )
+    thread.start()
+
+    done_event.wait()
+
+    time.sleep(3)  # let the last timer run
+
+    f = h5pyd.File("http://localhost:5010/", "r")
+    assert list(f["map/massfractions/Fe K/values"].shape) == [10]
+    assert f["control/points"][()] == 10
 
     stop_event.set()
 
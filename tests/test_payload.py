@@ -0,0 +1,106 @@
+import pickle
+
+import h5py
+import numpy as np
+from PyMca5.PyMcaIO import ConfigDict
+
+from src.fit import PreparedFit
+from src.payload import (
+    CompressedArray,
+    PayloadCodec,
+    crop_spectrum,
+    fit_window,
+    lossless_dtype,
+    restore_spectra,
+)
+
+CONFIG = "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg"
+
+
+def test_lossless_dtype():
+    assert lossless_dtype(np.array([0, 200], dtype=np.uint32)) == np.uint8
+    assert lossless_dtype(np.array([0, 70000], dtype=np.uint32)) == np.uint32
+    assert lossless_dtype(np.array([-1, 300], dtype=np.int64)) == np.int16
+    assert lossless_dtype(np.array([0.5, 2.0])) == np.float64
+
+
+def test_restore():
+    config = ConfigDict.ConfigDict()
+    config.read(CONFIG)
+    with h5py.File("data/scan_000008_xspress3.hdf5", "r") as f:
+        spectra = f["entry/instrument/xspress3/data"][400:420, 3]
+
+    window = fit_window(config, spectra.shape[-1], margin=32)
+    assert window == slice(68, 1283)
+    cropped = [crop_spectrum(s, window) for s in spectra]
+    assert cropped[0]["counts"].nbytes < spectra[0][window].nbytes
+
+    restored = restore_spectra(cropped, window.start, window.stop - window.start)
+    assert np.array_equal(restored, spectra[:, window])
+    # mixed payloads in the full frame
+    full = restore_spectra(cropped[:10] + list(spectra[10:]), 0, spectra.shape[-1])
+    assert np.array_equal(full[:, window], spectra[:, window])
+    assert np.array_equal(full[10:], spectra[10:])
+    assert not full[:10, : window.start].any()
+
+
+def test_cropped_fit():
+    config = ConfigDict.ConfigDict()
+    config.read(CONFIG)
+    with h5py.File("data/scan_000008_xspress3.hdf5", "r") as f:
+        spectra = f["entry/instrument/xspress3/data"][400:500, 3]
+    window = fit_window(config, spectra.shape[-1], margin=32)
+    cropped = restore_spectra(
+        [crop_spectrum(s, window) for s in spectra],
+        window.start,
+        window.stop - window.start,
+    )
+
+    fullFit = PreparedFit()
+    fullFit.setFitConfigurationFile(CONFIG)
+    fullFit.prepare(y=spectra, weight=0, concentrations=1)
+    cropFit = PreparedFit()
+    cropFit.setFitConfigurationFile(CONFIG)
+    cropFit.prepare(
+        y=cropped, x=np.arange(window.start, window.stop), weight=0, concentrations=1
+    )
+
+    expected = fullFit.fit(spectra, refit=1, concentrations=1)
+    result = cropFit.fit(cropped, refit=1, concentrations=1)
+    for maptype, (labels, values) in result.items():
+        assert list(labels) == list(expected[maptype][0])
+        assert np.allclose(values, expected[maptype][1], rtol=1e-4)
+
+
+def test_codec():
+    with h5py.File("data/scan_000008_xspress3.hdf5", "r") as f:
+        spectrum = f["entry/instrument/xspress3/data"][100, 3]
+    fit = np.random.default_rng(0).random((5, 300))
+    payload = {
+        "position": {"x": 1.0, "y": np.float64(2.0)},
+        "spectrum": spectrum,
+        "fit": {"results": (["Fe K", "Ar K"], fit), "small": np.arange(4)},
+    }
+    worker = PayloadCodec(min_bytes=1024)
+    encoded = pickle.loads(pickle.dumps(worker.encode(payload)))
+    assert isinstance(encoded["spectrum"], CompressedArray)
+    assert isinstance(encoded["fit"]["results"][1], CompressedArray)
+    assert encoded["fit"]["results"][0] == ["Fe K", "Ar K"]
+    assert isinstance(encoded["fit"]["small"], np.ndarray)
+    assert encoded["codec"]["raw_bytes"] == spectrum.nbytes + fit.nbytes
+    assert len(pickle.dumps(encoded)) < len(pickle.dumps(payload))
+
+    reducer = PayloadCodec()
+    decoded = reducer.decode(encoded)
+    assert "codec" not in decoded
+    assert np.array_equal(decoded["spectrum"], spectrum)
+    assert decoded["spectrum"].dtype == spectrum.dtype
+    assert np.array_equal(decoded["fit"]["results"][1], fit)
+    assert isinstance(decoded["fit"]["results"], tuple)
+    stats = reducer.stats()
+    assert stats["payloads"] == 1
+    assert stats["ratio"] > 2
+    assert stats["decode_seconds"] > 0
+
+    assert worker.encode({"position": {"x": 1.0}}) == {"position": {"x": 1.0}}
+    assert reducer.decode(payload) is payload
@@ -0,0 +1,93 @@
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from src.recording import (
+    IndexedRecording,
+    RecordingSource,
+    fly_numbers,
+    index_path,
+    main,
+)
+
+EIGER = "data/eigerseiger-1m-ingester-d0b20b4c-3605-4a55-b3c0-2ffc0a3d55ed.cbors"
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = tmp_path / "xspress_ingest.pkls"
+    shutil.copy("data/xspress_ingest.pkls", path)
+    return path
+
+
+def test_index(recording):
+    rec = IndexedRecording(recording)
+    assert len(rec) == 22
+    assert rec.streams == ["xspress3"]
+    assert list(rec.numbers) == list(range(22))
+
+    assert rec.read(rec.find(7)).event_number == 7
+    with pytest.raises(KeyError):
+        rec.find(100)
+    assert [m.event_number for m in rec.messages(5, 9)] == [5, 6, 7, 8]
+    assert len(list(rec.messages(stream="contrast"))) == 0
+
+    # loaded from the sidecar, rebuilt once the recording changed
+    assert IndexedRecording(recording).index["offsets"][-1] == recording.stat().st_size
+    with open(recording, "ab") as f:
+        f.write(open("data/xspress_ingest.pkls", "rb").read())
+    assert len(IndexedRecording(recording)) == 44
+
+
+def test_cbors(tmp_path):
+    path = tmp_path / "eiger.cbors"
+    shutil.copy(EIGER, path)
+    rec = IndexedRecording(path)
+    assert rec.streams == ["eiger-1m"]
+    msg = rec.read(rec.find(3))
+    assert msg.event_number == 3
+    assert msg.streams["eiger-1m"].typ == "STINS"
+
+
+def test_renumber(recording):
+    rec = IndexedRecording(recording)
+    numbers = fly_numbers(len(rec), 5, 2)
+    assert list(numbers[:8]) == [0, 1, 2, 3, 4, 7, 8, 9]
+    rec.renumber(numbers)
+    assert [m.event_number for m in rec.records(4, 7)] == [4, 7, 8]
+
+    rec = IndexedRecording(recording)
+    assert np.array_equal(rec.numbers, numbers)
+    assert rec.index["events"][5] == 5
+    rec.renumber({5: 50})
+    assert rec.read(5).event_number == 50
+    with pytest.raises(ValueError):
+        rec.renumber([1, 2])
+
+
+def test_parallel(recording):
+    rec = IndexedRecording(recording)
+    ranges = rec.split(3)
+    assert ranges == [(0, 7), (7, 14), (14, 22)]
+
+    def read(bounds):
+        return [msg.event_number for msg in rec.records(*bounds)]
+
+    with ThreadPoolExecutor(3) as pool:
+        parts = list(pool.map(read, ranges))
+    assert sum(parts, []) == list(range(22))
+
+
+def test_source(recording, monkeypatch):
+    monkeypatch.setenv("RECORDINGS", f'{{"files": ["{recording}"], "start": 20}}')
+    (gen,) = RecordingSource().get_source_generators()
+    assert [m.event_number for m in gen] == [20, 21]
+
+
+def test_main(recording):
+    assert main(["index", str(recording)]) == 0
+    assert main(["renumber", str(recording), "--width", "10", "--first", "1"]) == 0
+    with np.load(index_path(recording)) as npz:
+        assert list(npz["numbers"][9:12]) == [10, 13, 14]
@@ -0,0 +1,70 @@
+import io
+
+import numpy as np
+import pytest
+
+from src.roi import RoiReducer, parse_masks, parse_ranges, parse_rects, range_weights
+
+
+def test_parse():
+    assert parse_rects("") == {}
+    assert parse_rects('{"peak": [1, 3, 2, 5]}') == {"peak": [1, 3, 2, 5]}
+    with pytest.raises(ValueError):
+        parse_rects('{"peak": [1, 3]}')
+
+    buf = io.BytesIO()
+    np.savez(buf, ring=np.eye(3, dtype=np.uint8))
+    masks = parse_masks(buf.getvalue())
+    assert masks["ring"].dtype == bool
+    assert masks["ring"].sum() == 3
+
+
+def test_reduce():
+    rng = np.random.default_rng(0)
+    img = rng.poisson(5, (40, 60)).astype(np.uint32)
+    img[7, :] = np.iinfo(np.uint32).max  # masked detector line
+    expected = img.astype(np.float64)
+    expected[7, :] = 0
+
+    mask = np.zeros(img.shape, dtype=bool)
+    mask[::3, ::5] = True
+    reducer = RoiReducer(
+        rects={
+            "peak": [2, 10, 5, 50],
+            "empty": [50, 60, 0, 10],
+            "edge": [30, 45, -5, 4],
+        },
+        masks={"grid": mask, "other": np.ones((5, 5), dtype=bool)},
+    )
+    for frame in [img, rng.poisson(5, (40, 60)).astype(np.uint32)]:
+        expected = frame.astype(np.float64)
+        expected[7, :] = 0
+        ret = reducer(frame)
+        assert set(ret) == {"total", "com_x", "com_y", "peak", "empty", "edge", "grid"}
+        assert ret["total"] == expected.sum()
+        assert ret["peak"] == expected[2:10, 5:50].sum()
+        assert ret["empty"] == 0
+        assert ret["edge"] == expected[30:45, 0:4].sum()
+        assert ret["grid"] == expected[mask].sum()
+        ys, xs = np.indices(frame.shape)
+        assert np.isclose(ret["com_y"], (ys * expected).sum() / expected.sum())
+        assert np.isclose(ret["com_x"], (xs * expected).sum() / expected.sum())
+
+    ret = RoiReducer()(np.zeros((4, 4), dtype=np.uint16))
+    assert ret["total"] == 0
+    assert np.isnan(ret["com_x"])
+
+
+def test_ranges():
+    assert parse_ranges("") == {}
+    with pytest.raises(ValueError):
+        parse_ranges('{"ring": [2, 1]}')
+
+    q = np.linspace(0.05, 4.95, 50)
+    intensity = np.exp(-q)
+    names, weights = range_weights(q, parse_ranges('{"a": [1, 2], "none": [9, 10]}'))
+    assert names == ["a", "none"]
+    values = weights @ intensity
+    inside = (q >= 1) & (q < 2)
+    assert np.isclose(values[0], intensity[inside].sum() * 0.1)
+    assert values[1] == 0
@@ -0,0 +1,98 @@
+import numpy as np
+
+from src.storage import GrowableArray, EventArray, annotate
+
+
+def test_growable():
+    arr = GrowableArray(dtype=np.float32, capacity=4)
+    assert np.array(arr).shape == (0,)
+
+    arr.extend(np.arange(3))
+    arr.append(3)
+    assert arr.capacity == 4
+    arr.extend(np.arange(4, 10))
+    assert arr.capacity == 10
+    arr.append(10)
+    assert arr.capacity == 20
+
+    assert len(arr) == 11
+    assert arr.shape == (11,)
+    assert np.array(arr).dtype == np.float32
+    assert np.array_equal(np.array(arr), np.arange(11))
+    assert np.shares_memory(np.asarray(arr), arr.view)
+    assert arr[-1] == 10
+
+
+def test_growable_rows():
+    arr = GrowableArray(dtype=np.uint16, shape=(3,), capacity=1)
+    arr.append([1, 2, 3])
+    arr.extend(np.ones((5, 3)))
+    assert arr.shape == (6, 3)
+    assert np.array_equal(np.array(arr)[0], [1, 2, 3])
+
+
+def test_event_array():
+    arr = EventArray(dtype=np.float32, capacity=2)
+    arr.put([3, 1], [30, 10])
+    assert arr.watermark == 1
+    assert arr.count == 2
+    assert np.array_equal(arr.valid.view, [True, False, True])
+    assert np.isnan(arr[1])
+
+    arr.put(np.arange(4, 8), np.arange(40, 80, 10))
+    assert arr.watermark == 1
+    arr.put([2], [20])
+    assert arr.watermark == 7
+    assert np.array_equal(np.array(arr), np.arange(10, 80, 10))
+
+    # replace a range in place
+    arr.put(np.arange(2, 4), [-2, -3])
+    assert np.array_equal(np.array(arr)[:4], [10, -2, -3, 40])
+    assert arr.count == 7
+
+
+def test_event_array_gaps():
+    # a fly scan arms the panda between the lines, these events have no result
+    width, gap, horizon = 121, 2, 50
+    arr = EventArray(dtype=np.float32, horizon=horizon)
+    lines = [1 + line * (width + gap) + np.arange(width) for line in range(5)]
+    arr.put(lines[0], lines[0])
+    assert arr.fill == width
+    for events in lines[1:]:
+        arr.put(events[:10], events[:10])
+        # the gap is still within the horizon
+        assert arr.fill == events[0] - 1 - gap
+        arr.put(events[10:], events[10:])
+        assert arr.fill == len(arr) == events[-1]
+    assert arr.count == 5 * width
+
+    # a point missing within the horizon holds the watermark back until it arrives
+    arr = EventArray(dtype=np.float32, horizon=horizon)
+    arr.put(np.arange(1, 41), np.arange(1, 41))
+    arr.put(np.arange(42, 61), np.arange(42, 61))
+    assert arr.fill == 40
+    arr.put([41], [41])
+    assert arr.fill == 60
+
+
+def test_annotate():
+    values = EventArray(dtype=np.float32)
+    rows = GrowableArray(dtype=np.float64)
+    tree = {"map": {"values": values, "values_attrs": {"units": "counts"}}, "x": rows}
+
+    annotate(tree)
+    assert tree["map"]["values_attrs"] == {"units": "counts", "fill": 0, "version": 0}
+    assert tree["x_attrs"] == {"fill": 0, "version": 0}
+
+    values.put([1, 2, 4], [1, 2, 4])
+    rows.extend([1.0, 2.0])
+    annotate(tree)
+    attrs = tree["map"]["values_attrs"]
+    assert attrs["fill"] == 2 and attrs["version"] == 1
+    assert tree["x_attrs"] == {"fill": 2, "version": 1}
+
+    values.put([3], [3])
+    annotate(tree)
+    assert tree["map"]["values_attrs"]["fill"] == 4
+    assert tree["map"]["values_attrs"]["version"] == 2
+    assert tree["map"]["values_attrs"]["units"] == "counts"
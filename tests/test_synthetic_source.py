@@ -0,0 +1,99 @@
+import json
+import time
+
+import h5py
+import numpy as np
+import pytest
+from dranspose.data.xspress3 import XspressImage
+from dranspose.event import EventData
+from dranspose.middlewares.xspress import parse as xspress_parse
+from dranspose.replay import get_parameters
+
+from src.reducer import FluorescenceReducer
+from src.synthetic_source import SyntheticFly, SyntheticScan
+from src.worker import FluorescenceWorker
+
+
+def events(generators):
+    """
+    merges the generators by event number like replay
+    """
+    cache = [next(gen) for gen in generators]
+    while len(cache) > 0:
+        low = min(msg.event_number for msg in cache)
+        yield EventData.from_internals([m for m in cache if m.event_number == low])
+        pending = []
+        for gen, msg in zip(generators, cache):
+            if msg.event_number == low:
+                msg = next(gen, None)
+            if msg is not None:
+                pending.append((gen, msg))
+        generators = [gen for gen, _ in pending]
+        cache = [msg for _, msg in pending]
+
+
+def test_fly(tmp_path):
+    param_file = tmp_path / "params.json"
+    param_file.write_text(
+        json.dumps([{"name": "eiger_rois", "data": '{"a": [0, 100, 0, 100]}'}])
+    )
+    parameters = get_parameters(param_file, FluorescenceWorker, FluorescenceReducer)
+    worker = FluorescenceWorker(parameters=parameters)
+
+    source = SyntheticFly(
+        width=4, height=3, streams=("xspress3", "panda0", "eiger-1m"), frames=2
+    )
+    points = {}
+    streams = {}
+    for event in events(source.get_source_generators()):
+        streams[event.event_number] = sorted(event.streams)
+        ret = worker.process_event(event, parameters)
+        if ret is not None and "spectrum" in ret:
+            assert set(ret["eiger"]["eiger-1m"]) == {"total", "com_x", "com_y", "a"}
+            points[event.event_number] = (ret["position"], ret["spectrum"])
+
+    assert sorted(points) == [1, 2, 3, 4, 7, 8, 9, 10, 13, 14, 15, 16]
+    # the panda is re-armed in the gaps between the lines
+    assert streams[5] == streams[6] == ["panda0"]
+    assert streams[17] == ["eiger-1m", "panda0", "xspress3"]
+    position, spectrum = points[8]
+    assert (position["x"], position["y"]) == pytest.approx((0.1, 0.1))
+    assert spectrum.shape == (4096,)
+
+
+def test_lazy(monkeypatch):
+    monkeypatch.setenv("SYNTHETIC_SCAN", '{"rate": 200, "streams": ["panda0"]}')
+    source = SyntheticScan()
+    assert source.points == 1000000
+    (pcap,) = source.get_source_generators()
+
+    start = time.monotonic()
+    numbers = [next(pcap).event_number for _ in range(41)]
+    assert numbers == list(range(41))
+    # the first point is sent immediately, the next 39 at 200 Hz
+    assert time.monotonic() - start >= 39 / 200
+
+    monkeypatch.setenv("SYNTHETIC_SCAN", '{"size": 3}')
+    with pytest.raises(ValueError):
+        SyntheticScan()
+
+
+def test_spectra():
+    source = SyntheticScan(width=3, height=1, streams=("xspress3",), seed=1)
+    (xspress,) = source.get_source_generators()
+    msgs = list(xspress)
+    assert [m.event_number for m in msgs] == [0, 1, 2, 3, 4]
+
+    with h5py.File(source.spectra, "r") as f:
+        real = f["entry/instrument/xspress3/data"][:3]
+        dtc = f["entry/instrument/xspress3/dead_time_correction"][:3]
+    for msg, spectrum, factors in zip(msgs[1:4], real, dtc):
+        image = xspress_parse(msg.streams["xspress3"])
+        assert isinstance(image, XspressImage)
+        assert image.data.shape == spectrum.shape
+        assert np.array_equal(image.meta["dtc"], factors)
+        # poisson noise around the real counts
+        assert not np.array_equal(image.data, spectrum)
+        assert abs(int(image.data.sum()) - int(spectrum.sum())) < 5 * np.sqrt(
+            spectrum.sum() + 1
+        )
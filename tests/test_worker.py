@@ -1,11 +1,17 @@
+import json
 import logging
 import cbor2
 import threading
 import time
 from glob import glob
 
+import h5py
 import h5pyd
-from dranspose.replay import replay
+import numpy as np
+from dranspose.replay import get_parameters, replay
+
+from src.reducer import FluorescenceReducer
+from src.worker import FluorescenceWorker
 
 
 def test_pilatus():
@@ -39,6 +45,43 @@ def test_pilatus():
     thread.join()
 
 
+def test_pilatus_rois(tmp_path):
+    stop_event = threading.Event()
+    done_event = threading.Event()
+
+    with open("params.json") as f:
+        params = json.load(f)
+    params.append({"name": "azint_rois", "data": '{"ring": [0.5, 2.0]}'})
+    param_file = tmp_path / "params.json"
+    param_file.write_text(json.dumps(params))
+
+    thread = threading.Thread(
+        target=replay,
+        args=(
+            "src.worker:FluorescenceWorker",
+            "src.reducer:FluorescenceReducer",
+            None,
+            "src.hdf5_sources:PilatusSource",
+            param_file,
+        ),
+        kwargs={"port": 5010, "stop_event": stop_event, "done_event": done_event},
+    )
+    thread.start()
+
+    done_event.wait()
+
+    time.sleep(1)  # let the timer integrate the ranges
+
+    f = h5pyd.File("http://localhost:5010/", "r")
+    assert list(f["azint/data"].shape) == [10, 100]
+    assert f["azint/data"].dtype == "float32"
+    assert list(f["map/azint/ring/values"].shape) == [10]
+
+    stop_event.set()
+
+    thread.join()
+
+
 def test_contrast(tmp_path):
     stop_event = threading.Event()
     done_event = threading.Event()
@@ -77,3 +120,54 @@ def test_contrast(tmp_path):
     stop_event.set()
 
     thread.join()
+
+
+def test_crop_without_config(tmp_path):
+    with open("params.json") as f:
+        params = json.load(f)
+    params.append({"name": "spectrum_crop", "data": "True"})
+    param_file = tmp_path / "params.json"
+    param_file.write_text(json.dumps(params))
+    parameters = get_parameters(param_file, FluorescenceWorker, FluorescenceReducer)
+
+    # the unset mca_config is passed with an empty default
+    assert "mca_config" in parameters
+    worker = FluorescenceWorker(parameters=parameters)
+    assert worker.crop_config is None
+    spectrum = np.arange(4096)
+    assert worker._crop(spectrum, parameters) is spectrum
+
+
+def test_worker_fit_batch(tmp_path, caplog):
+    bin_file = tmp_path / "binparams.pkl"
+    with open(bin_file, "wb") as f:
+        with open(
+            "data/fit_config_scan_000027_0.1_second_some_elements_removed.cfg", "rb"
+        ) as cf:
+            cbor2.dump(
+                [
+                    {"name": "mca_config", "data": cf.read()},
+                    {"name": "worker_fit", "data": b"True"},
+                    {"name": "worker_fit_batch", "data": b"4"},
+                ],
+                f,
+            )
+    parameters = get_parameters(bin_file, FluorescenceWorker, FluorescenceReducer)
+    with caplog.at_level(logging.WARNING):
+        worker = FluorescenceWorker(parameters=parameters)
+    assert "worker_fit_batch 4 is not supported" in caplog.text
+
+    with h5py.File("data/scan_000008_xspress3.hdf5") as f:
+        spectra = f["entry/instrument/xspress3/data"][:5, 3]
+    # every event of the worker is fitted, none waits for a later one
+    for i, spectrum in enumerate(spectra[:4]):
+        worker.fit_buffer.append((i + 1, float(i), 0.0, spectrum.astype(np.float64)))
+        fit = worker._fit(parameters)["fit"]
+        assert list(fit["events"]) == [i + 1]
+    assert worker.fit_buffer == []
+
+    worker.fit_buffer.append((5, 4.0, 0.0, spectra[4].astype(np.float64)))
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        worker.finish(parameters)
+    assert "dropped 1 unfitted spectra of events [5]" in caplog.text
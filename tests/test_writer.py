@@ -0,0 +1,48 @@
+import time
+
+import bitshuffle.h5
+import h5py
+import numpy as np
+
+from src.writer import ResultWriter, chunk_shape, merge_rows
+
+
+def test_merge_rows():
+    rows, values = merge_rows(np.array([3, 1, 3, 2]), np.array([30, 10, 31, 20]))
+    assert rows.tolist() == [1, 2, 3]
+    assert values.tolist() == [10, 20, 31]
+    assert chunk_shape((100,), np.float32, 4000) == (10, 100)
+    assert chunk_shape((10000,), np.float64, 4000) == (1, 10000)
+
+
+def test_writer(tmp_path):
+    path = str(tmp_path / "results.h5")
+    writer = ResultWriter(path, flush_interval=0.05)
+    writer.put("position/x", [3, 1, 2], [0.3, 0.1, 0.2])
+    writer.put("spectra", [1, 2], np.arange(8, dtype=np.uint16).reshape(2, 4))
+    time.sleep(0.5)
+
+    with h5py.File(path, "r", swmr=True) as f:
+        assert f["position/x"][:].tolist() == [0.1, 0.2, 0.3]
+        assert str(bitshuffle.h5.H5FILTER) in f["spectra"]._filters
+        assert f["spectra"].chunks[1:] == (4,)
+
+    # out of order, with gaps and a dataset which needs leaving SWMR mode
+    writer.put("position/x", [7, 5], [0.7, 0.5])
+    writer.put("map/massfractions/Fe K", [2], [0.02])
+    writer.set("azint/q", np.linspace(0, 1, 5), {"units": "nm^-1"})
+    writer.close()
+    writer.close()
+    writer.put("position/x", [8], [0.8])
+
+    with h5py.File(path, "r") as f:
+        x = f["position/x"][:]
+        assert x[:3].tolist() == [0.1, 0.2, 0.3]
+        assert np.isnan(x[3]) and x[4] == 0.5 and x[6] == 0.7
+        assert len(x) == 7
+        assert np.isnan(f["map/massfractions/Fe K"][0])
+        assert f["azint/q"].attrs["units"] == "nm^-1"
+    stats = writer.stats()
+    assert stats["written"] == 8
+    assert stats["reopened"] >= 1
+    assert stats["closed"] == 1 and stats["error"] == ""
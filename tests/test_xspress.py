@@ -0,0 +1,47 @@
+import h5py
+import numpy as np
+import pytest
+
+from src.xspress import ElementSum, parse_elements, sum_dtype
+
+
+def test_parse_elements():
+    assert parse_elements("3") == [3]
+    assert parse_elements("0, 2,1") == [0, 1, 2]
+    assert parse_elements("0-3") == [0, 1, 2, 3]
+    with pytest.raises(ValueError):
+        parse_elements("")
+
+
+def test_element_sum():
+    with h5py.File("data/scan_000008_xspress3.hdf5") as fh:
+        data = fh["entry/instrument/xspress3/data"][:10]
+        dtc = fh["entry/instrument/xspress3/dead_time_correction"][:10]
+
+    single = ElementSum([3])
+    assert np.shares_memory(single(data[0]), data[0])
+
+    total = ElementSum([0, 1, 2, 3])
+    out = np.empty(data.shape[2], dtype=sum_dtype(data.dtype))
+    for frame in data:
+        assert total(frame, out=out) is out
+        assert np.array_equal(out, frame.sum(axis=0))
+
+    # sums of full channels do not wrap around
+    full = np.full((4, 8), np.iinfo(np.uint32).max, dtype=np.uint32)
+    assert (total(full) == 4 * int(np.iinfo(np.uint32).max)).all()
+    assert total(full).dtype == np.uint64
+    assert total(full.astype(np.int16)).dtype == np.int64
+    assert total(full.astype(np.float32)).dtype == np.float32
+
+    corrected = ElementSum([1, 3], dead_time_correction=True)
+    out = np.empty(data.shape[2])
+    for frame, factors in zip(data, dtc):
+        expected = factors[1] * frame[1] + factors[3] * frame[3]
+        assert np.allclose(corrected(frame, dtc=factors), expected)
+        assert np.allclose(corrected(frame, dtc=factors, out=out), expected)
+    # frames without meta data are summed without correction
+    assert np.array_equal(corrected(data[0]), data[0][[1, 3]].sum(axis=0))
+
+    with pytest.raises(IndexError):
+        ElementSum([4])(data[0])